@@ -0,0 +1,30 @@
+# coding: utf-8
+"""
+Expose an ASGI-compatible application to serve with an asyncio webserver.
+
+Run this script to serve it with the built-in asyncio server, or use any ASGI
+server, for instance ``uvicorn asgi:application``.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import os
+
+import bottle
+
+from server.__main__ import init, start_periodic_tasks
+from server.asgi import AsgiApplication, serve
+
+
+init()
+application = app = AsgiApplication(bottle.default_app())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    start_periodic_tasks()
+    serve(
+        app,
+        host=os.environ.get('HOST', '127.0.0.1'),
+        port=int(os.environ.get('PORT', '8081'))
+    )
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Move the inactive reports (expired or downvoted) out of the reports table,
+to the archived reports table.
+
+Meant to be run periodically, for instance from a cron job. Alternatively,
+the server can archive reports itself, see the ``ARCHIVE_INTERVAL``
+environment variable.
+"""
+import logging
+import os
+import sys
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.abspath(os.path.join(SCRIPT_DIRECTORY, '..')))
+
+from server.models import db, archive_reports, ARCHIVE_BATCH_SIZE
+
+level = logging.WARN
+if 'DEBUG' in os.environ:
+    level = logging.INFO
+logging.basicConfig(level=level)
+
+
+if __name__ == '__main__':
+    db.connect()
+    batch_size = ARCHIVE_BATCH_SIZE
+    if len(sys.argv) > 1:
+        batch_size = int(sys.argv[1])
+    nb_archived = archive_reports(batch_size=batch_size)
+    logging.info('Archived %d reports.', nb_archived)
+    db.close()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Benchmark the serialization of reports listings, comparing the model-based
+serialization (``Report.to_json`` and ``Report.to_geojson_feature``) with
+``server.serializers``.
+
+Runs against a temporary in-memory SQLite database.
+"""
+import json
+import os
+import random
+import sys
+import timeit
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.abspath(os.path.join(SCRIPT_DIRECTORY, '..', '..')))
+
+# Never run against an actual database
+os.environ['DATABASE'] = 'sqlite:///:memory:'
+
+import arrow
+
+from server import serializers
+from server.jsonapi import DateAwareJSONEncoder, JsonApiStreamList
+from server.models import db, Counter, Report
+from server.tools import UTC_now
+
+SIZES = [10000, 100000]
+REPEAT = 3
+
+
+def populate(nb_reports):
+    """
+    Fill the database with random reports.
+    """
+    Report.delete().execute()
+    now = UTC_now()
+    rows = []
+    for _ in range(nb_reports):
+        lat, lng = random.uniform(42, 51), random.uniform(-4, 8)
+        shape_geojson = random.choice([None, json.dumps({
+            'type': 'LineString',
+            'coordinates': [
+                [lng + i / 10000.0, lat + i / 10000.0] for i in range(50)
+            ]
+        })])
+        rows.append({
+            'type': random.choice(['pothole', 'accident', 'interrupt']),
+            'lat': lat,
+            'lng': lng,
+            'first_report_datetime': now,
+            'datetime': now.replace(microsecond=random.choice([0, 1234])),
+            'expiration_datetime': random.choice([
+                None, arrow.get(now).shift(hours=+1).naive
+            ]),
+            'source': 'benchmark',
+            'shape_geojson': shape_geojson,
+        })
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            Report.insert_many(rows[i:i + 500]).execute()
+
+
+def serialize_models():
+    return json.dumps(
+        {"data": [r.to_json() for r in Report.select()]},
+        cls=DateAwareJSONEncoder
+    )
+
+
+def serialize_tuples():
+    return ''.join(JsonApiStreamList(
+        '{"data": [', serializers.reports_to_json(Report.select()), ']}'
+    ))
+
+
+def serialize_models_geojson():
+    return json.dumps(
+        {
+            "type": "FeatureCollection",
+            "features": [r.to_geojson_feature() for r in Report.select()]
+        },
+        cls=DateAwareJSONEncoder
+    )
+
+
+def serialize_tuples_geojson():
+    return ''.join(JsonApiStreamList(
+        '{"type": "FeatureCollection", "features": [',
+        serializers.reports_to_geojson_features(Report.select()),
+        ']}',
+        encoded=True
+    ))
+
+
+BENCHMARKS = [
+    ('json', serialize_models, serialize_tuples),
+    ('geojson', serialize_models_geojson, serialize_tuples_geojson),
+]
+
+
+if __name__ == '__main__':
+    db.connect()
+    db.create_tables([Counter, Report])
+    for nb_reports in SIZES:
+        populate(nb_reports)
+        for name, models_function, tuples_function in BENCHMARKS:
+            assert models_function() == tuples_function()
+            models_time = min(
+                timeit.repeat(models_function, number=1, repeat=REPEAT)
+            )
+            tuples_time = min(
+                timeit.repeat(tuples_function, number=1, repeat=REPEAT)
+            )
+            print('{} reports, {}: models {:.3f}s, tuples {:.3f}s'.format(
+                nb_reports, name, models_time, tuples_time
+            ))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Benchmark the serving of the API to concurrent slow clients, comparing the
+WSGI servers of ``python -m server`` with the asyncio server of ``asgi.py``.
+
+Slow clients send their requests a few bytes at a time while fast clients
+poll the stats and the reports listing. The latency seen by the fast clients
+is reported for each server.
+
+Runs against a temporary SQLite database, each server in its own process.
+"""
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIRECTORY = os.path.abspath(os.path.join(SCRIPT_DIRECTORY, '..', '..'))
+sys.path.append(ROOT_DIRECTORY)
+
+# Never run against an actual database
+DATABASE_FILE = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+os.environ['DATABASE'] = 'sqlite+pool:///' + DATABASE_FILE
+os.environ.pop('API_TOKEN', None)
+
+from server.__main__ import init
+from server.models import db, Report
+
+HOST = '127.0.0.1'
+PORT = 8097
+NB_REPORTS = 1000
+NB_SLOW_CLIENTS = 20
+NB_FAST_CLIENTS = 4
+# Slow clients take this number of seconds to send their request
+SLOW_REQUEST_DURATION = 2.0
+DURATION = 5.0
+PATHS = [
+    '/api/v1/stats',
+    '/api/v1/reports?filter[bbox]=2.25,48.81,2.42,48.90',
+]
+
+SERVERS = [
+    ('wsgi (python -m server)', [sys.executable, '-m', 'server'], {}),
+    (
+        'wsgi (python -m server, 2 workers of 8 threads)',
+        [sys.executable, '-m', 'server'],
+        {'WORKERS': '2', 'THREADS': '8'}
+    ),
+    ('asgi (python asgi.py)', [sys.executable, 'asgi.py'], {}),
+]
+
+
+def populate():
+    """
+    Fill the database with reports around Paris.
+    """
+    init()
+    db.connect()
+    with db.atomic():
+        for i in range(NB_REPORTS):
+            Report.create(
+                type='pothole',
+                lat=48.81 + (i % 100) / 1000.0,
+                lng=2.25 + (i // 100) / 100.0,
+            )
+    db.close()
+
+
+def wait_for_server():
+    for _ in range(100):
+        try:
+            socket.create_connection((HOST, PORT), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start.')
+
+
+def slow_client(stop, completed):
+    """
+    Send requests a byte at a time, until stopped.
+    """
+    request = (
+        'GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(
+            PATHS[0], HOST
+        ).encode('ascii')
+    )
+    delay = SLOW_REQUEST_DURATION / len(request)
+    while not stop.is_set():
+        try:
+            sock = socket.create_connection((HOST, PORT), timeout=30)
+            for i in range(len(request)):
+                sock.sendall(request[i:i + 1])
+                time.sleep(delay)
+            while sock.recv(65536):
+                pass
+            sock.close()
+            completed.append(1)
+        except OSError:
+            pass
+
+
+def fast_client(stop, latencies, errors):
+    """
+    Poll the API on a kept-alive connection, recording the latencies.
+    """
+    connection = http.client.HTTPConnection(HOST, PORT, timeout=30)
+    i = 0
+    while not stop.is_set():
+        path = PATHS[i % len(PATHS)]
+        i += 1
+        start = time.time()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            latencies.append(time.time() - start)
+        except (OSError, http.client.HTTPException) as exc:
+            errors.append(type(exc).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection(HOST, PORT, timeout=30)
+    connection.close()
+
+
+def run(command, server_env):
+    """
+    Start a server and load it.
+
+    :return: The latencies of the fast clients, the number of failed fast
+        requests and the number of completed slow requests.
+    """
+    env = dict(os.environ, HOST=HOST, PORT=str(PORT), **server_env)
+    process = subprocess.Popen(
+        command, cwd=ROOT_DIRECTORY, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_server()
+        stop = threading.Event()
+        latencies, errors, completed = [], [], []
+        threads = [
+            threading.Thread(target=slow_client, args=(stop, completed))
+            for _ in range(NB_SLOW_CLIENTS)
+        ] + [
+            threading.Thread(
+                target=fast_client, args=(stop, latencies, errors)
+            )
+            for _ in range(NB_FAST_CLIENTS)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(DURATION)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return latencies, len(errors), len(completed)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    populate()
+    try:
+        for name, command, server_env in SERVERS:
+            latencies, nb_errors, nb_slow = run(command, server_env)
+            if latencies:
+                latencies.sort()
+                summary = 'median {:.1f}ms, p95 {:.1f}ms'.format(
+                    statistics.median(latencies) * 1000,
+                    latencies[int(len(latencies) * 0.95)] * 1000
+                )
+            else:
+                summary = 'no response'
+            print(
+                '{}: {} fast requests ({}, {} errors), {} slow '
+                'requests'.format(
+                    name, len(latencies), summary, nb_errors, nb_slow
+                )
+            )
+    finally:
+        os.remove(DATABASE_FILE)
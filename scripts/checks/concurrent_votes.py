@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Check that votes are not lost when many clients vote on the same report at
+the same time. Set VOTES_FLUSH_INTERVAL to check the votes buffer as well.
+
+Many threads upvote and downvote the same report through the API, against a
+temporary SQLite database. Exits with a non-zero status if the final number
+of votes does not match the number of votes sent.
+"""
+import io
+import os
+import sys
+import tempfile
+import threading
+import wsgiref.util
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.abspath(os.path.join(SCRIPT_DIRECTORY, '..', '..')))
+
+# Never run against an actual database
+DATABASE_FILE = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+os.environ['DATABASE'] = 'sqlite+pool:///' + DATABASE_FILE
+os.environ.pop('API_TOKEN', None)
+
+import bottle
+
+from server import routes
+from server.__main__ import init
+from server.models import db, get_reports_stats, Report
+
+NB_THREADS = 16
+NB_VOTES_PER_THREAD = 50
+
+
+def request(method, path):
+    """
+    Serve a request and consume the response.
+
+    :return: The status of the response.
+    """
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'wsgi.input': io.BytesIO(b''),
+        'CONTENT_LENGTH': '0',
+    }
+    wsgiref.util.setup_testing_defaults(environ)
+    responses = []
+    body = bottle.default_app()(
+        environ, lambda status, headers, exc_info=None: responses.append(status)
+    )
+    for _ in body:
+        pass
+    if hasattr(body, 'close'):
+        body.close()
+    return responses[0]
+
+
+def vote(report_id, errors):
+    """
+    Send votes on a report, alternating upvotes and downvotes.
+    """
+    for i in range(NB_VOTES_PER_THREAD):
+        action = 'upvote' if i % 2 == 0 else 'downvote'
+        status = request(
+            'POST', '/api/v1/reports/{}/{}'.format(report_id, action)
+        )
+        if not status.startswith('200'):
+            errors.append(status)
+
+
+def main():
+    init()
+    db.connect()
+    report = Report.create(type='accident', lat=48.842, lng=2.386)
+    db.close()
+
+    errors = []
+    threads = [
+        threading.Thread(target=vote, args=(report.id, errors))
+        for _ in range(NB_THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db.connect()
+    # Write the votes still pending, when run with VOTES_FLUSH_INTERVAL
+    routes.votes_buffer.flush()
+    report = Report.get(Report.id == report.id)
+    nb_reports, nb_active_reports, _, _ = get_reports_stats()
+    db.close()
+    os.remove(DATABASE_FILE)
+
+    nb_votes = NB_THREADS * NB_VOTES_PER_THREAD
+    expected_upvotes = nb_votes - nb_votes // 2
+    print('{} upvotes (expected {}), {} downvotes (expected {}).'.format(
+        report.upvotes, expected_upvotes,
+        report.downvotes, nb_votes // 2
+    ))
+    print('{} active reports out of {} (expected 1 out of 1).'.format(
+        nb_active_reports, nb_reports
+    ))
+    if errors:
+        print('{} failed votes: {}.'.format(len(errors), set(errors)))
+    if (
+        errors or
+        report.upvotes != expected_upvotes or
+        report.downvotes != nb_votes // 2 or
+        (nb_reports, nb_active_reports) != (1, 1)
+    ):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Check that the hot queries on the reports do not scan the whole reports
+table, using SQLite ``EXPLAIN QUERY PLAN``.
+
+The queries of the API are captured while serving actual requests, against a
+temporary SQLite database filled with mostly expired reports. Exits with a
+non-zero status if any of them does a full table scan.
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import urllib.parse
+import wsgiref.util
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.abspath(os.path.join(SCRIPT_DIRECTORY, '..', '..')))
+
+# Never run against an actual database
+DATABASE_FILE = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+os.environ['DATABASE'] = 'sqlite:///' + DATABASE_FILE
+
+import arrow
+import bottle
+
+from server import geo
+from server.__main__ import init
+from server.models import (db, init_stats, Report,
+                           REPORT_DOWNVOTES_THRESHOLD)
+from server.tools import UTC_now
+
+NB_REPORTS = 20000
+
+
+class QueriesRecorder(logging.Handler):
+    """
+    Record the queries executed by peewee.
+    """
+    def __init__(self):
+        super(QueriesRecorder, self).__init__(logging.DEBUG)
+        self.queries = []
+
+    def emit(self, record):
+        if isinstance(record.msg, tuple):
+            self.queries.append(record.msg)
+
+
+def populate():
+    """
+    Fill the database with random reports, most of them being expired.
+    """
+    now = UTC_now()
+    rows = []
+    for i in range(NB_REPORTS):
+        lat, lng = random.uniform(42, 51), random.uniform(-4, 8)
+        expiration_datetime = random.choice([
+            None,
+            arrow.get(now).shift(hours=+1).naive,
+        ] + [
+            arrow.get(now).shift(days=-random.randint(1, 1000)).naive
+        ] * 18)
+        rows.append({
+            'type': random.choice(['pothole', 'accident', 'interrupt']),
+            'lat': lat,
+            'lng': lng,
+            'datetime': now,
+            'first_report_datetime': now,
+            'expiration_datetime': expiration_datetime,
+            'downvotes': random.choice([0] * 9 + [1]),
+            'source': 'check',
+            'grid_cell': geo.grid_cell(lat, lng),
+        })
+    db.connect(reuse_if_open=True)
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            Report.insert_many(rows[i:i + 500]).execute()
+        # Counters are as if the last sweep happened an hour ago
+        init_stats(arrow.get(now).shift(hours=-1).naive)
+    db.execute_sql('ANALYZE')
+    db.close()
+
+
+def request(path):
+    """
+    Serve a GET request and consume the response.
+    """
+    if '?' in path:
+        path, query_string = path.split('?', 1)
+    else:
+        query_string = ''
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+    }
+    wsgiref.util.setup_testing_defaults(environ)
+    responses = []
+    body = bottle.default_app()(
+        environ, lambda status, headers, exc_info=None: responses.append(status)
+    )
+    for _ in body:
+        pass
+    if hasattr(body, 'close'):
+        body.close()
+    if not responses[0].startswith('200'):
+        raise RuntimeError('GET {}: {}'.format(path, responses[0]))
+
+
+def importers_query():
+    """
+    Query of the active reports of a given type, as in scripts/opendata.
+    """
+    db.connect(reuse_if_open=True)
+    list(Report.select().where(
+        (Report.type == 'interrupt') &
+        (
+            (
+                (Report.expiration_datetime != None) &
+                (Report.expiration_datetime > UTC_now())
+            ) |
+            (
+                (Report.expiration_datetime == None) &
+                (Report.downvotes < REPORT_DOWNVOTES_THRESHOLD)
+            )
+        )
+    ))
+    db.close()
+
+
+def main():
+    init()
+    populate()
+
+    now = urllib.parse.quote(arrow.utcnow().isoformat())
+    hot_queries = [
+        # Active reports poll of the client
+        ('active reports',
+         lambda: request(
+             '/api/v1/reports?filter[expiration_datetime][gt?]=' + now
+         )),
+        ('stats', lambda: request('/api/v1/stats')),
+        ('map tile', lambda: request('/api/v1/tiles/13/4150/2818')),
+        ('clusters',
+         lambda: request(
+             '/api/v1/reports?aggregate=grid&zoom=10&filter[bbox]=2,48,3,49'
+         )),
+        ('importers lookup', importers_query),
+    ]
+
+    recorder = QueriesRecorder()
+    logger = logging.getLogger('peewee')
+    logger.addHandler(recorder)
+    logger.setLevel(logging.DEBUG)
+
+    failures = 0
+    for name, run in hot_queries:
+        recorder.queries = []
+        run()
+        for sql, params in recorder.queries:
+            if not sql.startswith('SELECT') or '"report"' not in sql:
+                continue
+            db.connect(reuse_if_open=True)
+            plan = [
+                row[-1] for row in
+                db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+            ]
+            db.close()
+            # Full table scans are reported as "SCAN <table>" (or "SCAN
+            # TABLE <table>" on older SQLite versions), without any index
+            scans = [
+                x for x in plan
+                if x.startswith('SCAN') and 'INDEX' not in x
+            ]
+            status = 'FAIL' if scans else 'OK'
+            if scans:
+                failures += 1
+            print('{} [{}] {}'.format(status, name, sql))
+            for line in plan:
+                print('    ' + line)
+
+    os.remove(DATABASE_FILE)
+    if failures:
+        print('{} queries scan the reports table.'.format(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
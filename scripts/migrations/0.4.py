@@ -17,11 +17,11 @@ from server.tools import UTC_now
 
 
 def run_migration():
-    if type(db) == peewee.SqliteDatabase:
+    if isinstance(db, peewee.SqliteDatabase):
         migrator = SqliteMigrator(db)
-    elif type(db) == peewee.MySQLDatabase:
+    elif isinstance(db, peewee.MySQLDatabase):
         migrator = MySQLMigrator(db)
-    elif type(db) == peewee.PostgresqlDatabase:
+    elif isinstance(db, peewee.PostgresqlDatabase):
         migrator = PostgresqlMigrator(db)
     else:
         return
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Database migration from < 0.5 to 0.5 version.
+"""
+import os
+import sys
+
+import peewee
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.abspath(os.path.join(SCRIPT_DIRECTORY, '..', '..')))
+
+from playhouse.migrate import *
+
+from server import geo
+from server.models import db, init_stats, ArchivedReport, Counter, Report
+
+
+def run_migration():
+    if isinstance(db, peewee.SqliteDatabase):
+        migrator = SqliteMigrator(db)
+    elif isinstance(db, peewee.MySQLDatabase):
+        migrator = MySQLMigrator(db)
+    elif isinstance(db, peewee.PostgresqlDatabase):
+        migrator = PostgresqlMigrator(db)
+    else:
+        return
+
+    db.create_tables([Counter, ArchivedReport])
+    migrate(
+        migrator.add_column(
+            'report', 'grid_cell',
+            peewee.IntegerField(default=None, null=True, index=True)
+        ),
+        migrator.add_column(
+            'report', 'shape_extent',
+            peewee.DoubleField(default=None, null=True, index=True)
+        ),
+        migrator.add_column(
+            'report', 'change_seq',
+            peewee.BigIntegerField(default=0, index=True)
+        ),
+        # Indexes for the hot queries
+        migrator.add_index('report', ('datetime',), False),
+        migrator.add_index('report', ('expiration_datetime',), False),
+        migrator.add_index(
+            'report', ('type', 'expiration_datetime', 'downvotes'), False
+        ),
+    )
+    # Backfill the spatial index key
+    with db.atomic():
+        query = Report.select(Report.id, Report.lat, Report.lng).tuples()
+        for id, lat, lng in query:
+            Report.update(
+                grid_cell=geo.grid_cell(lat, lng)
+            ).where(Report.id == id).execute()
+
+    # Normalize the shapes, which are now output verbatim
+    with db.atomic():
+        query = Report.select(Report.id, Report.shape_geojson).where(
+            Report.shape_geojson != None
+        ).tuples()
+        for id, shape_geojson in query:
+            try:
+                shape_geojson = geo.normalize_geojson_geometry(shape_geojson)
+            except ValueError:
+                shape_geojson = None
+            Report.update(
+                shape_geojson=shape_geojson
+            ).where(Report.id == id).execute()
+
+    # Backfill the extent of the shapes, once normalized
+    with db.atomic():
+        query = Report.select(
+            Report.id, Report.lat, Report.lng, Report.shape_geojson
+        ).where(Report.shape_geojson != None).tuples()
+        for id, lat, lng, shape_geojson in query:
+            Report.update(
+                shape_extent=geo.shape_extent(shape_geojson, lat, lng)
+            ).where(Report.id == id).execute()
+
+    # Compute the stats counters, which are then maintained on each write
+    init_stats()
+
+
+if __name__ == '__main__':
+    db.connect()
+    run_migration()
@@ -24,7 +24,8 @@ from shapely.geometry import Point
 from shapely.geometry import mapping, shape
 from shapely.ops import transform
 
-from server.models import db, Report
+from server.geo import normalize_geojson_geometry
+from server.models import create_reports, db, Report
 from server.tools import UTC_now
 
 level = logging.WARN
@@ -154,13 +155,13 @@ def process_opendata(name, data, report_type=REPORT_TYPE):
         (
             # Either with an expiration_datetime in the future
             (
-                (Report.expiration_datetime is not None) &
+                (Report.expiration_datetime != None) &
                 (Report.expiration_datetime > UTC_now())
             ) |
             # Or without expiration_datetime but which are still active (shown
             # on the map)
             (
-                (Report.expiration_datetime is None) &
+                (Report.expiration_datetime == None) &
                 (Report.downvotes < REPORT_DOWNVOTES_THRESHOLD)
             )
         )
@@ -179,67 +180,87 @@ def process_opendata(name, data, report_type=REPORT_TYPE):
         if x['fields'].get('state') not in ['FLUIDE', 'INCONNU']
     ]
 
-    for item in data:
-        try:
-            fields = item['fields']
-
-            # Get geometry and position
-            geometry = shape(item['geometry'])
-            position = geometry.centroid
-            lng, lat = position.x, position.y
-
-            # Check if this precise position is already in the database
-            if transform(project, position) in current_reports_points:
-                logging.info(
-                    ('Ignoring record %s, a similar report is already in '
-                        'the database.'),
-                    item['recordid']
-                )
-                continue
-            # Check no similar reports is within the area of the report, up
-            # to the report distance.
-            overlap_area = transform(project, geometry).buffer(
-                MIN_DISTANCE_REPORT_DETAILS
-            )
-            is_already_inserted = False
-            for report_point in current_reports_points:
-                if report_point.within(overlap_area):
-                    # A similar report is already there
-                    is_already_inserted = True
+    # Reports are inserted at the end, by batches, so that the write lock
+    # is not held during the processing. Reports accepted before an
+    # unexpected error are still inserted.
+    new_reports = []
+    try:
+        for item in data:
+            try:
+                fields = item['fields']
+
+                # Get geometry and position
+                geometry = shape(item['geometry'])
+                position = geometry.centroid
+                lng, lat = position.x, position.y
+
+                # Check if this precise position is already in the database
+                if transform(project, position) in current_reports_points:
                     logging.info(
-                        ('Ignoring record %s, a similar report is already '
-                            'in the database.'),
+                        ('Ignoring record %s, a similar report is already in '
+                            'the database.'),
                         item['recordid']
                     )
-                    break
-            if is_already_inserted:
-                # Skip this report if a similar one is nearby
-                continue
-
-            # Expires in an hour
-            expiration_datetime = (
-                # TODO: Check the datetime value in the opendata file
-                arrow.get(fields['datetime']).shift(hours=+1).naive
-            )
+                    continue
+                # Check no similar reports is within the area of the report, up
+                # to the report distance.
+                overlap_area = transform(project, geometry).buffer(
+                    MIN_DISTANCE_REPORT_DETAILS
+                )
+                is_already_inserted = False
+                for report_point in current_reports_points:
+                    if report_point.within(overlap_area):
+                        # A similar report is already there
+                        is_already_inserted = True
+                        logging.info(
+                            ('Ignoring record %s, a similar report is already '
+                                'in the database.'),
+                            item['recordid']
+                        )
+                        break
+                if is_already_inserted:
+                    # Skip this report if a similar one is nearby
+                    continue
+
+                # Expires in an hour
+                expiration_datetime = (
+                    # TODO: Check the datetime value in the opendata file
+                    arrow.get(fields['datetime']).shift(hours=+1).naive
+                )
 
-            # Add the report to the db
-            logging.info('Adding record %s to the database.',
-                         item['recordid'])
-            Report.create(
-                type=report_type,
-                expiration_datetime=expiration_datetime,
-                lat=lat,
-                lng=lng,
-                source=item['source'],
-                shape_geojson=json.dumps(mapping(geometry))
-            )
-        except KeyError as exc:
-            logging.warning(
-                'Invalid record %s in %s, missing key: %s',
-                item.get('recordid', '?'),
-                name,
-                exc
-            )
+                # Shapes are output verbatim, normalize them (unsupported ones,
+                # such as geometry collections, are dropped)
+                try:
+                    shape_geojson = normalize_geojson_geometry(
+                        json.dumps(mapping(geometry))
+                    )
+                except ValueError:
+                    logging.warning(
+                        'Ignoring the unsupported shape of record %s.',
+                        item['recordid']
+                    )
+                    shape_geojson = None
+
+                # Add the report to the db, with the other ones
+                logging.info('Adding record %s to the database.',
+                             item['recordid'])
+                new_reports.append(Report(
+                    type=report_type,
+                    expiration_datetime=expiration_datetime,
+                    lat=lat,
+                    lng=lng,
+                    source=item['source'],
+                    shape_geojson=shape_geojson
+                ))
+            except KeyError as exc:
+                logging.warning(
+                    'Invalid record %s in %s, missing key: %s',
+                    item.get('recordid', '?'),
+                    name,
+                    exc
+                )
+    finally:
+        create_reports(new_reports)
 
 
 if __name__ == '__main__':
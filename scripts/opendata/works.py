@@ -22,7 +22,8 @@ from shapely.geometry import (LineString, MultiPolygon, MultiLineString,
 from shapely.geometry import mapping, shape
 from shapely.ops import transform
 
-from server.models import db, Report
+from server.geo import normalize_geojson_geometry
+from server.models import create_reports, db, Report
 from server.tools import UTC_now
 
 level = logging.WARN
@@ -600,13 +601,13 @@ def process_opendata(name, data, report_type=REPORT_TYPE):
         (
             # Either with an expiration_datetime in the future
             (
-                (Report.expiration_datetime is not None) &
+                (Report.expiration_datetime != None) &
                 (Report.expiration_datetime > UTC_now())
             ) |
             # Or without expiration_datetime but which are still active (shown
             # on the map)
             (
-                (Report.expiration_datetime is None) &
+                (Report.expiration_datetime == None) &
                 (Report.downvotes < REPORT_DOWNVOTES_THRESHOLD)
             )
         )
@@ -616,125 +617,147 @@ def process_opendata(name, data, report_type=REPORT_TYPE):
             transform(project, Point(report.lng, report.lat))
         )
 
-    for item in data:
-        try:
-            fields = item['fields']
-
-            # Check that the work is currently being done
-            now = arrow.now('Europe/Paris')
-            if fields['date_debut']:
-                start_date = arrow.get(fields['date_debut'].replace('/', '-'))
-            else:
-                # Defaults to now if start date is unknown
-                start_date = arrow.get(now)
-            if fields['date_fin']:
-                end_date = arrow.get(fields['date_fin'].replace('/', '-'))
-            else:
-                # Defaults to in a week if start date is unknown
-                end_date = arrow.get(now).shift(days=+7)
-            if not (start_date < now < end_date):
-                logging.info(
-                    'Ignoring record %s, work not currently in progress.',
-                    item['recordid']
-                )
-                continue
-
-            # Report geographical shape
-            if 'geo_shape' in fields:
-                maybe_multi_geo_shape = shape(fields['geo_shape'])
-            else:
-                maybe_multi_geo_shape = shape(item['geometry'])
-
-            geo_shapes = []
-            if (
-                isinstance(maybe_multi_geo_shape, MultiPolygon)
-                or isinstance(maybe_multi_geo_shape, MultiPoint)
-            ):
-                # Split MultiPolygon into multiple Polygon
-                # Same for MultiPoint
-                positions = [
-                    p.centroid
-                    for p in maybe_multi_geo_shape
-                ]
-                geo_shapes = [
-                    p
-                    for p in maybe_multi_geo_shape
-                ]
-            elif isinstance(maybe_multi_geo_shape, MultiLineString):
-                # Split MultiLineString into multiple LineString
-                positions = [
-                    p.interpolate(0.5, normalized=True)
-                    for p in maybe_multi_geo_shape
-                ]
-                geo_shapes = [
-                    p
-                    for p in maybe_multi_geo_shape
-                ]
-            elif isinstance(maybe_multi_geo_shape, LineString):
-                # LineString, interpolate midpoint
-                positions = [
-                    maybe_multi_geo_shape.interpolate(0.5, normalized=True)
-                ]
-                geo_shapes = [maybe_multi_geo_shape]
-            else:
-                # Polygon or Point
-                positions = [
-                    maybe_multi_geo_shape.centroid
-                ]
-                geo_shapes = [maybe_multi_geo_shape]
-
-            for (geo_shape, position) in zip(geo_shapes, positions):
-                # Check if this precise position is already in the database
-                if transform(project, position) in current_reports_points:
+    # Reports are inserted at the end, by batches, so that the write lock
+    # is not held during the processing. Reports accepted before an
+    # unexpected error are still inserted.
+    new_reports = []
+    try:
+        for item in data:
+            try:
+                fields = item['fields']
+
+                # Check that the work is currently being done
+                now = arrow.now('Europe/Paris')
+                if fields['date_debut']:
+                    start_date = arrow.get(
+                        fields['date_debut'].replace('/', '-')
+                    )
+                else:
+                    # Defaults to now if start date is unknown
+                    start_date = arrow.get(now)
+                if fields['date_fin']:
+                    end_date = arrow.get(fields['date_fin'].replace('/', '-'))
+                else:
+                    # Defaults to in a week if start date is unknown
+                    end_date = arrow.get(now).shift(days=+7)
+                if not (start_date < now < end_date):
                     logging.info(
-                        ('Ignoring record %s, a similar report is already in '
-                            'the database.'),
+                        'Ignoring record %s, work not currently in progress.',
                         item['recordid']
                     )
                     continue
-                # Check no similar reports is within the area of the report, up
-                # to the report distance.
-                overlap_area = transform(project, geo_shape).buffer(
-                    MIN_DISTANCE_REPORT_DETAILS
-                )
-                is_already_inserted = False
-                for report_point in current_reports_points:
-                    if report_point.within(overlap_area):
-                        # A similar report is already there
-                        is_already_inserted = True
+
+                # Report geographical shape
+                if 'geo_shape' in fields:
+                    maybe_multi_geo_shape = shape(fields['geo_shape'])
+                else:
+                    maybe_multi_geo_shape = shape(item['geometry'])
+
+                geo_shapes = []
+                if (
+                    isinstance(maybe_multi_geo_shape, MultiPolygon)
+                    or isinstance(maybe_multi_geo_shape, MultiPoint)
+                ):
+                    # Split MultiPolygon into multiple Polygon
+                    # Same for MultiPoint
+                    positions = [
+                        p.centroid
+                        for p in maybe_multi_geo_shape
+                    ]
+                    geo_shapes = [
+                        p
+                        for p in maybe_multi_geo_shape
+                    ]
+                elif isinstance(maybe_multi_geo_shape, MultiLineString):
+                    # Split MultiLineString into multiple LineString
+                    positions = [
+                        p.interpolate(0.5, normalized=True)
+                        for p in maybe_multi_geo_shape
+                    ]
+                    geo_shapes = [
+                        p
+                        for p in maybe_multi_geo_shape
+                    ]
+                elif isinstance(maybe_multi_geo_shape, LineString):
+                    # LineString, interpolate midpoint
+                    positions = [
+                        maybe_multi_geo_shape.interpolate(0.5, normalized=True)
+                    ]
+                    geo_shapes = [maybe_multi_geo_shape]
+                else:
+                    # Polygon or Point
+                    positions = [
+                        maybe_multi_geo_shape.centroid
+                    ]
+                    geo_shapes = [maybe_multi_geo_shape]
+
+                for (geo_shape, position) in zip(geo_shapes, positions):
+                    # Check if this precise position is already in the database
+                    if transform(project, position) in current_reports_points:
                         logging.info(
-                            ('Ignoring record %s, a similar report is already '
-                             'in the database.'),
+                            ('Ignoring record %s, a similar report is '
+                             'already in the database.'),
                             item['recordid']
                         )
-                        break
-                if is_already_inserted:
-                    # Skip this report if a similar one is nearby
-                    continue
-
-                # Get the position of the center of the item
-                lng, lat = position.x, position.y
-                # Compute expiration datetime
-                expiration_datetime = end_date.replace(microsecond=0).naive
-
-                # Add the report to the db
-                logging.info('Adding record %s to the database.',
-                             item['recordid'])
-                Report.create(
-                    type=report_type,
-                    expiration_datetime=expiration_datetime,
-                    lat=lat,
-                    lng=lng,
-                    source=item['source'],
-                    shape_geojson=json.dumps(mapping(geo_shape))
+                        continue
+                    # Check no similar reports is within the area of the
+                    # report, up to the report distance.
+                    overlap_area = transform(project, geo_shape).buffer(
+                        MIN_DISTANCE_REPORT_DETAILS
+                    )
+                    is_already_inserted = False
+                    for report_point in current_reports_points:
+                        if report_point.within(overlap_area):
+                            # A similar report is already there
+                            is_already_inserted = True
+                            logging.info(
+                                ('Ignoring record %s, a similar report is '
+                                 'already in the database.'),
+                                item['recordid']
+                            )
+                            break
+                    if is_already_inserted:
+                        # Skip this report if a similar one is nearby
+                        continue
+
+                    # Get the position of the center of the item
+                    lng, lat = position.x, position.y
+                    # Compute expiration datetime
+                    expiration_datetime = end_date.replace(microsecond=0).naive
+
+                    # Shapes are output verbatim, normalize them (unsupported
+                    # ones, such as geometry collections, are dropped)
+                    try:
+                        shape_geojson = normalize_geojson_geometry(
+                            json.dumps(mapping(geo_shape))
+                        )
+                    except ValueError:
+                        logging.warning(
+                            'Ignoring the unsupported shape of record %s.',
+                            item['recordid']
+                        )
+                        shape_geojson = None
+
+                    # Add the report to the db, with the other ones
+                    logging.info('Adding record %s to the database.',
+                                 item['recordid'])
+                    new_reports.append(Report(
+                        type=report_type,
+                        expiration_datetime=expiration_datetime,
+                        lat=lat,
+                        lng=lng,
+                        source=item['source'],
+                        shape_geojson=shape_geojson
+                    ))
+            except KeyError as exc:
+                logging.warning(
+                    'Invalid record %s in %s, missing key: %s',
+                    item.get('recordid', '?'),
+                    name,
+                    exc
                 )
-        except KeyError as exc:
-            logging.warning(
-                'Invalid record %s in %s, missing key: %s',
-                item.get('recordid', '?'),
-                name,
-                exc
-            )
+    finally:
+        create_reports(new_reports)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,6 @@
+import os
+
+# Idle keep-alive connections are closed after this number of seconds by the
+# servers of server.asgi and server.prefork. It is also the maximum time to
+# receive the headers of a request.
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', '5'))
@@ -2,18 +2,36 @@
 # coding: utf-8
 import functools
 import json
+import logging
 import os
+import threading
+import time
 
 import bottle
 
-from server import routes
+from server import prefork, routes
 from server.jsonapi import DateAwareJSONEncoder
-from server.models import db, Report
+from server.models import (db, archive_reports, sweep_expired_reports,
+                           ArchivedReport, Counter, Report)
+
+# Interval between two archivals of the inactive reports, in seconds. 0
+# disables the in-process archival, see scripts/archive_reports.py instead.
+ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL', '0'))
+# Interval between two sweeps of the expired reports out of the stats
+# counters, in seconds. 0 disables the in-process sweeps, archivals sweep
+# as well.
+STATS_SWEEP_INTERVAL = int(os.environ.get('STATS_SWEEP_INTERVAL', '60'))
+# Number of worker processes, and of threads per worker process. With a
+# single worker of a single thread, the development server of Bottle is used.
+WORKERS = int(os.environ.get('WORKERS', '1'))
+THREADS = int(os.environ.get('THREADS', '1'))
 
 
 def init():
     db.connect()
-    db.create_tables([Report])
+    db.create_tables([Counter, Report, ArchivedReport])
+    # Compute the stats counters on a new database
+    sweep_expired_reports()
     if not db.is_closed():
         db.close()
 
@@ -26,10 +44,103 @@ def init():
     )
 
 
+def start_periodic_task(name, interval, task):
+    """
+    Run a database maintenance task periodically, in a background thread.
+
+    :param name: Name of the task, for the logs.
+    :param interval: Interval between two runs, in seconds.
+    :param task: Function running the task.
+    :return: The started thread.
+    """
+    def run_periodically():
+        while True:
+            time.sleep(interval)
+            db.connect(reuse_if_open=True)
+            try:
+                task()
+            except Exception:
+                logging.exception('Unable to run the %s.', name)
+            finally:
+                if not db.is_closed():
+                    db.close()
+
+    thread = threading.Thread(
+        target=run_periodically, name=name, daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def archive():
+    """
+    Archive the inactive reports.
+    """
+    nb_archived = archive_reports()
+    if nb_archived:
+        logging.info('Archived %d reports.', nb_archived)
+
+
+def start_periodic_tasks():
+    """
+    Start the enabled database maintenance tasks. Should be run by a single
+    process.
+    """
+    if ARCHIVE_INTERVAL > 0:
+        start_periodic_task('archival', ARCHIVE_INTERVAL, archive)
+    if STATS_SWEEP_INTERVAL > 0:
+        start_periodic_task(
+            'stats sweep', STATS_SWEEP_INTERVAL, sweep_expired_reports
+        )
+
+
+def start_worker(index):
+    """
+    Initialize a worker process of the pre-forked server.
+
+    :param index: Index of the worker.
+    """
+    # Check that the database can be reached from this worker, the
+    # connections of the master process are not shared
+    db.connect(reuse_if_open=True)
+    db.close()
+    # Archive the reports and sweep the stats from a single worker
+    if index == 0:
+        start_periodic_tasks()
+
+
+def stop_worker(index):
+    """
+    Clean up a worker process of the pre-forked server before it exits.
+
+    :param index: Index of the worker.
+    """
+    db.connect(reuse_if_open=True)
+    try:
+        # Write the votes still pending, if any
+        routes.votes_buffer.flush()
+    except Exception:
+        logging.exception('Unable to flush the pending votes.')
+    finally:
+        if not db.is_closed():
+            db.close()
+
+
 if __name__ == "__main__":
     init()
+    host = os.environ.get('HOST', '127.0.0.1')
+    port = int(os.environ.get('PORT', '8081'))
 
-    bottle.run(
-      host=os.environ.get('HOST', '127.0.0.1'),
-      port=int(os.environ.get('PORT', '8081'))
-    )
+    if WORKERS > 1 or THREADS > 1:
+        logging.basicConfig(level=logging.INFO)
+        # Do not let workers inherit connections of the master process
+        if hasattr(db, 'close_all'):
+            db.close_all()
+        prefork.serve(
+            bottle.default_app(), host, port, WORKERS, THREADS,
+            on_worker_start=start_worker, on_worker_stop=stop_worker
+        )
+    else:
+        start_periodic_tasks()
+
+        bottle.run(host=host, port=port)
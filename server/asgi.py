@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Asyncio serving of the API.
+
+The Bottle application is a WSGI application, doing blocking database calls.
+``AsgiApplication`` exposes it as an ASGI application: requests are read and
+responses are written by the event loop, without blocking, and the
+application itself runs on a bounded pool of threads. Slow clients thus only
+hold a thread while their request is actually processed, not while they
+upload their request or download the response.
+
+Streaming responses (``text/event-stream``, see the stream of changes) are
+long lived and mostly idle, so they are continued outside of this pool, on
+their own threads, once the application returned. They thus do not prevent
+other requests from being processed.
+
+Any ASGI server (``uvicorn asgi:application`` for instance) can serve it.
+``serve`` is a minimal asyncio HTTP/1.1 server, so that no additional
+dependency is required.
+"""
+import asyncio
+import concurrent.futures
+import http
+import io
+import logging
+import os
+import sys
+import threading
+from urllib.parse import unquote
+
+from server import KEEPALIVE_TIMEOUT
+
+# Maximum number of requests processed at once by the application
+ASGI_MAX_THREADS = int(os.environ.get('ASGI_MAX_THREADS', '8'))
+# Maximum number of streaming responses sent at once, on their own threads.
+# Beyond that, streams are ended after their first chunk.
+ASGI_MAX_STREAMS = int(os.environ.get('ASGI_MAX_STREAMS', '100'))
+# Number of chunks of a response which can be produced by the application
+# before they are sent to the client
+ASGI_MAX_PENDING_CHUNKS = 16
+# Requests with a larger body are rejected
+MAX_BODY_SIZE = 10 * 1024 * 1024
+MAX_HEADERS = 100
+
+# Marks the end of a response in the queue of chunks
+_END = object()
+
+
+class AsgiApplication(object):
+    """
+    Expose a WSGI application as an ASGI application, running it on a
+    bounded pool of threads.
+    """
+    def __init__(self, wsgi_app, max_threads=ASGI_MAX_THREADS,
+                 max_streams=ASGI_MAX_STREAMS):
+        """
+        :param wsgi_app: The WSGI application.
+        :param max_threads: Maximum number of requests processed at once.
+        :param max_streams: Maximum number of streaming responses sent at
+            once.
+        """
+        self.wsgi_app = wsgi_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_threads, thread_name_prefix='asgi'
+        )
+        self._streams = threading.BoundedSemaphore(max_streams)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError("Unsupported scope type: {}.".format(
+                scope['type']
+            ))
+
+        # Read the whole request body before using a thread
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        environ = _build_environ(scope, b''.join(body))
+
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(ASGI_MAX_PENDING_CHUNKS)
+        disconnected = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = loop.create_task(watch_disconnect())
+        running = loop.run_in_executor(
+            self.executor, self._run, environ, put, disconnected
+        )
+        try:
+            while True:
+                item = await chunks.get()
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    # Error of a streaming response, ending it
+                    raise item
+                if disconnected.is_set():
+                    # Let the application finish, discarding its output
+                    continue
+                try:
+                    await send(item)
+                except OSError:
+                    disconnected.set()
+            # Raise the errors of the application, if any
+            await running
+            if not disconnected.is_set():
+                try:
+                    await send({'type': 'http.response.body', 'body': b''})
+                except OSError:
+                    pass
+        finally:
+            watcher.cancel()
+
+    def _run(self, environ, put, disconnected):
+        """
+        Run the WSGI application on a request, in a thread of the pool.
+
+        :param environ: The WSGI environ of the request.
+        :param put: Function to pass the ASGI messages of the response to
+            the event loop, blocking when too many are pending.
+        :param disconnected: Event set when the client went away.
+        """
+        response = {}
+        streaming = False
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'], response['headers'] = status, headers
+            return write
+
+        def start():
+            if not response.get('started'):
+                response['started'] = True
+                put(_response_start(response['status'], response['headers']))
+
+        def write(data):
+            if data:
+                start()
+                put(_response_body(data))
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                iterator = iter(iterable)
+                for data in iterator:
+                    write(data)
+                    if disconnected.is_set():
+                        break
+                    if _is_stream(response) and not streaming:
+                        # Continue the stream outside of the pool, if
+                        # possible, otherwise end it
+                        if not self._streams.acquire(blocking=False):
+                            break
+                        streaming = True
+                        threading.Thread(
+                            target=self._run_stream,
+                            args=(iterable, iterator, write, put,
+                                  disconnected),
+                            name='asgi-stream', daemon=True
+                        ).start()
+                        return
+                start()
+            finally:
+                if not streaming and hasattr(iterable, 'close'):
+                    iterable.close()
+        finally:
+            if not streaming:
+                put(_END)
+
+    def _run_stream(self, iterable, iterator, write, put, disconnected):
+        """
+        Send the remaining chunks of a streaming response, on its own
+        thread, see ``_run``.
+        """
+        end = _END
+        try:
+            for data in iterator:
+                write(data)
+                if disconnected.is_set():
+                    break
+        except Exception as exc:
+            # Raised by the event loop
+            end = exc
+        finally:
+            try:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+            finally:
+                self._streams.release()
+                put(end)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def _is_stream(response):
+    """
+    Check whether a WSGI response is a long lived stream of events.
+    """
+    return any(
+        name.lower() == 'content-type' and
+        value.startswith('text/event-stream')
+        for name, value in response.get('headers', [])
+    )
+
+
+def _response_start(status, headers):
+    return {
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers
+        ],
+    }
+
+
+def _response_body(data):
+    return {'type': 'http.response.body', 'body': data, 'more_body': True}
+
+
+def _build_environ(scope, body):
+    """
+    Build the WSGI environ of a request, see PEP 3333.
+
+    :param scope: The ASGI scope of the request.
+    :param body: The request body, as bytes.
+    :return: The WSGI environ dict.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode(
+            'latin-1'
+        ),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+class _BadRequest(Exception):
+    def __init__(self, status):
+        super(_BadRequest, self).__init__(status)
+        self.status = status
+
+
+async def _read_request(reader):
+    """
+    Read the request line and headers of a request.
+
+    :return: A tuple of the method, target, HTTP version and list of
+        headers (as lowercase name and value bytes), or ``None`` if the
+        connection was closed.
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise _BadRequest(400)
+    if not version.startswith('HTTP/1.'):
+        raise _BadRequest(505)
+
+    headers = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            return None
+        if line in (b'\r\n', b'\n'):
+            break
+        if len(headers) >= MAX_HEADERS or b':' not in line:
+            raise _BadRequest(400)
+        name, value = line.split(b':', 1)
+        headers.append((name.strip().lower(), value.strip()))
+    return method, target, version[len('HTTP/'):], headers
+
+
+async def _handle_connection(application, reader, writer):
+    """
+    Serve the requests of a connection, keeping it alive between requests.
+    """
+    peer = writer.get_extra_info('peername')
+    sock = writer.get_extra_info('sockname')
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(
+                    _read_request(reader), KEEPALIVE_TIMEOUT
+                )
+            except _BadRequest as exc:
+                _write_error(writer, exc.status)
+                break
+            if request is None:
+                break
+            method, target, version, headers = request
+            header_values = dict(headers)
+
+            if b'chunked' in header_values.get(b'transfer-encoding', b''):
+                _write_error(writer, 411)
+                break
+            try:
+                length = int(header_values.get(b'content-length', b'0'))
+            except ValueError:
+                _write_error(writer, 400)
+                break
+            if length > MAX_BODY_SIZE:
+                _write_error(writer, 413)
+                break
+            if length and header_values.get(b'expect') == b'100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            body = await reader.readexactly(length) if length else b''
+
+            connection = header_values.get(b'connection', b'').lower()
+            keep_alive = (
+                version == '1.1' and connection != b'close' or
+                connection == b'keep-alive'
+            )
+            path, _, query_string = target.partition('?')
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0', 'spec_version': '2.1'},
+                'http_version': version,
+                'method': method.upper(),
+                'scheme': 'http',
+                'path': unquote(path),
+                'raw_path': path.encode('latin-1'),
+                'query_string': query_string.encode('latin-1'),
+                'root_path': '',
+                'headers': headers,
+                'client': peer[:2] if peer else None,
+                'server': sock[:2] if sock else None,
+            }
+            keep_alive = await _run_application(
+                application, scope, body, writer, keep_alive
+            )
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+            ConnectionError, ValueError):
+        # Idle, slow or gone clients, or too long lines
+        pass
+    finally:
+        writer.close()
+
+
+async def _run_application(application, scope, body, writer, keep_alive):
+    """
+    Run the ASGI application on a request and write its response.
+
+    :return: Whether the connection can be kept alive.
+    """
+    state = {
+        'started': False, 'chunked': False, 'done': False,
+        'keep_alive': keep_alive,
+    }
+    is_head = scope['method'] == 'HEAD'
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if writer.is_closing():
+            raise ConnectionResetError()
+        if message['type'] == 'http.response.start':
+            headers = list(message.get('headers', []))
+            names = [name.lower() for name, _ in headers]
+            if b'content-length' not in names and not is_head:
+                if scope['http_version'] == '1.1':
+                    state['chunked'] = True
+                    headers.append((b'transfer-encoding', b'chunked'))
+                else:
+                    state['keep_alive'] = False
+            headers.append((
+                b'connection',
+                b'keep-alive' if state['keep_alive'] else b'close'
+            ))
+            status = message['status']
+            lines = ['HTTP/{} {} {}'.format(
+                scope['http_version'], status, http.HTTPStatus(status).phrase
+            ).encode('latin-1')]
+            lines.extend(name + b': ' + value for name, value in headers)
+            writer.write(b'\r\n'.join(lines) + b'\r\n\r\n')
+            state['started'] = True
+        elif message['type'] == 'http.response.body':
+            data = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if not is_head:
+                if state['chunked']:
+                    if data:
+                        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    if not more_body:
+                        writer.write(b'0\r\n\r\n')
+                elif data:
+                    writer.write(data)
+            if not more_body:
+                state['done'] = True
+            try:
+                await writer.drain()
+            except ConnectionError:
+                disconnected.set()
+                raise
+
+    try:
+        await application(scope, receive, send)
+    except ConnectionError:
+        return False
+    except Exception:
+        logging.exception('Error while serving %s.', scope['path'])
+        if not state['started']:
+            _write_error(writer, 500)
+        return False
+    finally:
+        disconnected.set()
+    return state['done'] and state['keep_alive']
+
+
+def _write_error(writer, status):
+    phrase = http.HTTPStatus(status).phrase
+    writer.write(
+        'HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+        .format(status, phrase).encode('latin-1')
+    )
+
+
+def serve(application, host='127.0.0.1', port=8081):
+    """
+    Serve an ASGI application over HTTP/1.1, until interrupted.
+
+    :param application: The ASGI application.
+    :param host: Host to listen to.
+    :param port: Port to listen on.
+    """
+    async def main():
+        server = await asyncio.start_server(
+            lambda reader, writer: _handle_connection(
+                application, reader, writer
+            ),
+            host, port
+        )
+        logging.info('Serving on http://%s:%d/.', host, port)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+In-process cache of serialized API responses, and their compression.
+
+Entries are tagged with the data version (see
+``server.models.get_data_version``) they were computed for, so that any
+write to the database, from any process, invalidates them.
+"""
+import calendar
+import collections
+import email.utils
+import hashlib
+import os
+import threading
+import zlib
+
+import arrow
+import bottle
+import peewee
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from server.jsonapi import FILTER_RE
+
+# Maximum number of responses kept in cache
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '64'))
+# Responses larger than this number of bytes are not cached
+CACHE_MAX_BODY_SIZE = int(
+    os.environ.get('CACHE_MAX_BODY_SIZE', str(5 * 1024 * 1024))
+)
+# Datetime filters are rounded down to a multiple of this number of seconds,
+# so that clients polling with the current datetime share cache entries.
+CACHE_TIME_BUCKET = int(os.environ.get('CACHE_TIME_BUCKET', '60'))
+
+# Supported content encodings, by order of preference. Brotli is only
+# available if the brotli module is installed.
+ENCODINGS = (['br'] if brotli is not None else []) + ['gzip']
+GZIP_COMPRESSION_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class ResponseCache(object):
+    """
+    A thread-safe LRU cache of response bodies, tagged with a data version.
+
+    Compressed versions of the bodies are stored along with them, so that a
+    response is compressed at most once per data version.
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES,
+                 max_body_size=CACHE_MAX_BODY_SIZE):
+        self.max_entries = max_entries
+        self.max_body_size = max_body_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, encoding=None):
+        """
+        Get a cached response body.
+
+        :param key: Key of the response, see ``query_key``.
+        :param version: Current data version.
+        :param encoding: Optional content encoding of the body, see
+            ``negotiate_encoding``.
+        :return: The cached body (as bytes if an encoding was requested) or
+            ``None``.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                # Stale entry
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            body, encoded_bodies = entry[1], entry[2]
+            if encoding is None:
+                return body
+            if encoding in encoded_bodies:
+                return encoded_bodies[encoding]
+
+        # Compress outside of the lock, and keep the result for the next
+        # requests
+        encoded_body = compress(body, encoding)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                entry[2][encoding] = encoded_body
+        return encoded_body
+
+    def set(self, key, version, body, encoded_bodies=None):
+        """
+        Store a response body in the cache.
+
+        :param key: Key of the response, see ``query_key``.
+        :param version: Data version the body was computed for.
+        :param body: The response body.
+        :param encoded_bodies: Optional dict of compressed versions of the
+            body, by content encoding.
+        """
+        if self.max_entries <= 0 or len(body) > self.max_body_size:
+            return
+        with self._lock:
+            self._entries[key] = (version, body, dict(encoded_bodies or {}))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def set_from_stream(self, key, version, chunks, encoding=None):
+        """
+        Store a response body in the cache while it is streamed.
+
+        The body is only stored once the stream is fully consumed, and only
+        if it is not larger than the maximum body size.
+
+        :param key: Key of the response, see ``query_key``.
+        :param version: Data version the body is computed for.
+        :param chunks: An iterable of chunks of the response body.
+        :param encoding: Optional content encoding to compress the stream
+            with, see ``negotiate_encoding``.
+        :returns: A generator of the chunks of the response body, as bytes
+            if an encoding was requested.
+        """
+        body, encoded_body, size = [], [], 0
+        compressor = None
+        if encoding is not None:
+            compressor = Compressor(encoding)
+        for chunk in chunks:
+            if body is not None:
+                size += len(chunk)
+                if size > self.max_body_size:
+                    # Too large to be cached, stop buffering
+                    body, encoded_body = None, None
+                else:
+                    body.append(chunk)
+            if compressor is None:
+                yield chunk
+                continue
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                if encoded_body is not None:
+                    encoded_body.append(data)
+                yield data
+        if compressor is not None:
+            data = compressor.flush()
+            if encoded_body is not None:
+                encoded_body.append(data)
+            yield data
+        if body is not None:
+            encoded_bodies = None
+            if compressor is not None:
+                encoded_bodies = {encoding: b''.join(encoded_body)}
+            self.set(key, version, ''.join(body), encoded_bodies)
+
+    def clear(self):
+        """
+        Empty the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class Compressor(object):
+    """
+    Incremental compression of a response body, for a given content
+    encoding.
+    """
+    def __init__(self, encoding):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress = self._compressor.process
+            self._flush = self._compressor.finish
+        elif encoding == 'gzip':
+            # No timestamp is written in the gzip header, so that compressed
+            # bodies do not depend on when they were compressed
+            self._compressor = zlib.compressobj(
+                GZIP_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+            self._compress = self._compressor.compress
+            self._flush = self._compressor.flush
+        else:
+            raise ValueError("Unsupported encoding: {}.".format(encoding))
+
+    def compress(self, data):
+        """
+        Compress a chunk of data.
+
+        :param data: Chunk of the body, as bytes.
+        :return: The compressed data available so far, as bytes.
+        """
+        return self._compress(data)
+
+    def flush(self):
+        """
+        Finish the compression.
+
+        :return: The remaining compressed data, as bytes.
+        """
+        return self._flush()
+
+
+def compress(body, encoding):
+    """
+    Compress a response body.
+
+    :param body: The response body, as a string.
+    :param encoding: The content encoding, see ``negotiate_encoding``.
+    :return: The compressed body, as bytes.
+    """
+    compressor = Compressor(encoding)
+    return compressor.compress(body.encode('utf-8')) + compressor.flush()
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Pick the content encoding of a response.
+
+    :param accept_encoding: Value of the ``Accept-Encoding`` request header.
+    :return: The content encoding to use, or ``None`` to send the response
+        uncompressed.
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        quality = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def bucket_timestamp(timestamp):
+    """
+    Round down a timestamp to a multiple of ``CACHE_TIME_BUCKET`` seconds.
+
+    :param timestamp: A UNIX timestamp.
+    :return: The rounded down timestamp, as an integer.
+    """
+    timestamp = int(timestamp)
+    if CACHE_TIME_BUCKET > 0:
+        timestamp -= timestamp % CACHE_TIME_BUCKET
+    return timestamp
+
+
+def bucket_datetime(value):
+    """
+    Round down a datetime to a multiple of ``CACHE_TIME_BUCKET`` seconds.
+
+    :param value: A datetime, as an ISO 8601 string.
+    :return: The rounded down datetime, as an ISO 8601 string.
+    """
+    timestamp = calendar.timegm(
+        arrow.get(value).to('UTC').naive.utctimetuple()
+    )
+    return arrow.get(bucket_timestamp(timestamp)).isoformat()
+
+
+def normalize_query(query, model):
+    """
+    Normalize a query dict for caching, bucketing the values of the filters
+    on datetime fields.
+
+    :param query: A Bottle query dict.
+    :param model: Database model used in this query.
+    :return: A new Bottle query dict.
+    """
+    normalized = bottle.FormsDict()
+    for param, value in query.allitems():
+        filter_match = FILTER_RE.match(param)
+        if filter_match:
+            field = getattr(model, filter_match.group(1), None)
+            if isinstance(field, peewee.DateTimeField):
+                try:
+                    value = bucket_datetime(value)
+                except (TypeError, ValueError):
+                    # Let the query parser report the error
+                    pass
+        normalized.append(param, value)
+    return normalized
+
+
+def query_key(path, query):
+    """
+    Build a cache key from a normalized query.
+
+    :param path: Path of the requested route.
+    :param query: A Bottle query dict, see ``normalize_query``.
+    :return: A hashable cache key.
+    """
+    return (path, tuple(sorted(query.allitems())))
+
+
+def make_etag(key, version, encoding=None):
+    """
+    Build a strong ETag for a response.
+
+    :param key: Key of the response, see ``query_key``.
+    :param version: Data version the response is computed for.
+    :param encoding: Optional content encoding of the response.
+    :return: The ETag, as a quoted string.
+    """
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    if encoding is not None:
+        # Each representation has its own ETag
+        return '"{}-{}-{}"'.format(version, digest[:16], encoding)
+    return '"{}-{}"'.format(version, digest[:16])
+
+
+def _timestamp(value):
+    """
+    Convert a naive UTC datetime to an integer UNIX timestamp.
+    """
+    return calendar.timegm(value.utctimetuple())
+
+
+def is_not_modified(etag, last_modified=None):
+    """
+    Check the conditional headers of the current request against the
+    validators of the response.
+
+    :param etag: ETag of the response.
+    :param last_modified: Naive UTC datetime of the last modification of the
+        response, if known.
+    :return: ``True`` if the client copy is up to date.
+    """
+    if_none_match = bottle.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since
+        candidates = [
+            x.strip() for x in if_none_match.split(',')
+        ]
+        return '*' in candidates or any(
+            x[2:] == etag if x.startswith('W/') else x == etag
+            for x in candidates
+        )
+
+    if_modified_since = bottle.request.headers.get('If-Modified-Since')
+    if if_modified_since and last_modified is not None:
+        since = bottle.parse_date(if_modified_since)
+        return since is not None and since >= _timestamp(last_modified)
+
+    return False
+
+
+def set_validators(etag, last_modified=None, cache_control='no-cache'):
+    """
+    Set the validators headers of the current response.
+
+    :param etag: ETag of the response.
+    :param last_modified: Naive UTC datetime of the last modification of the
+        response, if known.
+    :param cache_control: Value of the ``Cache-Control`` header. By default,
+        clients should always revalidate their copy.
+    """
+    bottle.response.set_header('ETag', etag)
+    bottle.response.set_header('Cache-Control', cache_control)
+    if last_modified is not None:
+        bottle.response.set_header(
+            'Last-Modified',
+            email.utils.formatdate(_timestamp(last_modified), usegmt=True)
+        )
+
+
+def not_modified(etag, last_modified=None, cache_control='no-cache'):
+    """
+    Build an empty 304 Not Modified response.
+
+    :param etag: ETag of the response.
+    :param last_modified: Naive UTC datetime of the last modification of the
+        response, if known.
+    :param cache_control: Value of the ``Cache-Control`` header.
+    :return: The (empty) response body.
+    """
+    set_validators(etag, last_modified, cache_control)
+    bottle.response.status = 304
+    return ''
+
+
+# Cache of the responses of the reports listing
+responses_cache = ResponseCache()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Notification of the writes to the reports, within a process.
+
+Streams of changes wait on the notifier and are woken up as soon as reports
+are written by the same process. Writes from other processes (other server
+workers, the OpenData importers) are only noticed by the streams when they
+poll the data version (see ``server.models.get_data_version``).
+"""
+import threading
+
+
+class ChangeNotifier(object):
+    """
+    A thread-safe notifier of changes, counting the notifications.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    @property
+    def generation(self):
+        """
+        Number of notifications so far, to pass to ``wait``.
+        """
+        with self._condition:
+            return self._generation
+
+    def notify(self):
+        """
+        Wake up all the waiting threads. Should be called once the changes
+        are committed.
+        """
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout=None):
+        """
+        Wait for a notification.
+
+        :param generation: Generation the caller is up to date with.
+        :param timeout: Maximum time to wait for, in seconds.
+        :return: The current generation, equal to ``generation`` if the wait
+            timed out.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._generation != generation, timeout
+            )
+            return self._generation
+
+
+# Notifier of the writes to the reports
+notifier = ChangeNotifier()
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Geographical helpers, to evaluate area queries in the database.
+"""
+import json
+import math
+import numbers
+
+# Approximate length of a degree of latitude, in meters
+METERS_PER_DEGREE = 111320.0
+
+# Number of grid cells per degree, for the spatial index key. Cells are
+# about 1km high.
+GRID_RESOLUTION = 100
+# Number of cells in a row of the grid
+GRID_COLUMNS = 360 * GRID_RESOLUTION + 1
+# Maximum number of distinct ranges of cells to query for a bounding box.
+# Above this, a single range covering all the rows is used.
+GRID_MAX_RANGES = 32
+
+# Nesting depth of the coordinates of each GeoJSON geometry type
+GEOJSON_COORDINATES_DEPTH = {
+    'Point': 1,
+    'MultiPoint': 2,
+    'LineString': 2,
+    'MultiLineString': 3,
+    'Polygon': 3,
+    'MultiPolygon': 4,
+}
+
+# Maximum zoom level of the map tiles
+TILES_MAX_ZOOM = 22
+# Margin around a map tile, in degrees, to fetch the reports whose shape
+# (extending away from their position) may cross the tile through the
+# spatial index. Reports with larger shapes are fetched through the index on
+# their shape extent.
+TILES_SHAPE_MARGIN = 0.02
+# Number of clusters per map tile side, when aggregating reports
+CLUSTERS_PER_TILE = 4
+
+
+def parse_bbox(value):
+    """
+    Parse a bounding box passed as a query parameter.
+
+    :param value: A string ``minLng,minLat,maxLng,maxLat``.
+    :return: A tuple ``(min_lng, min_lat, max_lng, max_lat)`` of floats.
+    """
+    try:
+        min_lng, min_lat, max_lng, max_lat = [
+            float(x) for x in value.split(',')
+        ]
+    except ValueError:
+        raise ValueError(
+            "Invalid bounding box provided, expected "
+            "minLng,minLat,maxLng,maxLat."
+        )
+    if not (
+        -180 <= min_lng <= max_lng <= 180 and
+        -90 <= min_lat <= max_lat <= 90
+    ):
+        raise ValueError("Invalid bounding box provided, out of bounds.")
+    return min_lng, min_lat, max_lng, max_lat
+
+
+def parse_point(value):
+    """
+    Parse a point passed as a query parameter.
+
+    :param value: A string ``lat,lng``.
+    :return: A tuple ``(lat, lng)`` of floats.
+    """
+    try:
+        lat, lng = [float(x) for x in value.split(',')]
+    except ValueError:
+        raise ValueError("Invalid point provided, expected lat,lng.")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Invalid point provided, out of bounds.")
+    return lat, lng
+
+
+def radius_to_bbox(lat, lng, radius):
+    """
+    Compute the bounding box of a circle.
+
+    :param lat: Latitude of the center of the circle.
+    :param lng: Longitude of the center of the circle.
+    :param radius: Radius of the circle, in meters.
+    :return: A tuple ``(min_lng, min_lat, max_lng, max_lat)``.
+    """
+    delta_lat = radius / METERS_PER_DEGREE
+    # Avoid a division by zero next to the poles
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    delta_lng = min(radius / (METERS_PER_DEGREE * cos_lat), 180)
+    return (
+        max(lng - delta_lng, -180), max(lat - delta_lat, -90),
+        min(lng + delta_lng, 180), min(lat + delta_lat, 90)
+    )
+
+
+def grid_position(lat, lng):
+    """
+    Get the row and column of the spatial grid containing a point.
+
+    :param lat: Latitude of the point.
+    :param lng: Longitude of the point.
+    :return: A tuple ``(row, column)``.
+    """
+    return (
+        int(math.floor((lat + 90) * GRID_RESOLUTION)),
+        int(math.floor((lng + 180) * GRID_RESOLUTION))
+    )
+
+
+def grid_cell(lat, lng):
+    """
+    Compute the spatial index key of a point.
+
+    The world is split in a regular grid, numbered row by row, so that the
+    cells of a bounding box are contiguous ranges of keys.
+
+    :param lat: Latitude of the point.
+    :param lng: Longitude of the point.
+    :return: The integer id of the grid cell containing the point.
+    """
+    row, column = grid_position(lat, lng)
+    return row * GRID_COLUMNS + column
+
+
+def grid_cell_ranges(bbox):
+    """
+    Compute the ranges of spatial index keys covering a bounding box.
+
+    :param bbox: A tuple ``(min_lng, min_lat, max_lng, max_lat)``.
+    :return: A list of ``(first_cell, last_cell)`` tuples, bounds included.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    min_row, min_column = grid_position(min_lat, min_lng)
+    max_row, max_column = grid_position(max_lat, max_lng)
+    if max_row - min_row + 1 > GRID_MAX_RANGES:
+        # Too many rows, use a single coarser range
+        return [(
+            min_row * GRID_COLUMNS + min_column,
+            max_row * GRID_COLUMNS + max_column
+        )]
+    return [
+        (row * GRID_COLUMNS + min_column, row * GRID_COLUMNS + max_column)
+        for row in range(min_row, max_row + 1)
+    ]
+
+
+def bbox_filter(model, bbox):
+    """
+    Build a filter on the position of the items in a bounding box.
+
+    The condition on the spatial index key lets the database use an index
+    range scan, the conditions on the coordinates refine it.
+
+    :param model: Database model with ``lat``, ``lng`` and ``grid_cell``
+        fields.
+    :param bbox: A tuple ``(min_lng, min_lat, max_lng, max_lat)``.
+    :return: A peewee expression.
+    """
+    return _cells_filter(model, bbox) & _position_filter(model, bbox)
+
+
+def _cells_filter(model, bbox):
+    """
+    Build a filter on the spatial index key of the items in a bounding box,
+    also matching items next to it.
+    """
+    cells_filter = None
+    for first_cell, last_cell in grid_cell_ranges(bbox):
+        range_filter = model.grid_cell.between(first_cell, last_cell)
+        if cells_filter is None:
+            cells_filter = range_filter
+        else:
+            cells_filter = cells_filter | range_filter
+    return cells_filter
+
+
+def _position_filter(model, bbox):
+    """
+    Build a filter on the coordinates of the items in a bounding box.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return (
+        (model.lat >= min_lat) & (model.lat <= max_lat) &
+        (model.lng >= min_lng) & (model.lng <= max_lng)
+    )
+
+
+def distance_expression(model, lat, lng):
+    """
+    Build an SQL expression of the squared distance (in square meters) from
+    a given point, using an equirectangular approximation.
+
+    Only arithmetic operators are used so that it can be evaluated on any
+    database backend. The approximation is accurate enough at the scale of
+    a city.
+
+    :param model: Database model with ``lat`` and ``lng`` fields.
+    :param lat: Latitude of the reference point.
+    :param lng: Longitude of the reference point.
+    :return: A peewee expression.
+    """
+    lng_scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+    delta_lat = (model.lat - lat) * METERS_PER_DEGREE
+    delta_lng = (model.lng - lng) * lng_scale
+    return delta_lat * delta_lat + delta_lng * delta_lng
+
+
+def radius_filter(model, lat, lng, radius):
+    """
+    Build a filter on the items within a given distance from a point.
+
+    A bounding box condition is added so that the database can discard most
+    of the rows without computing the distance.
+
+    :param model: Database model with ``lat``, ``lng`` and ``grid_cell``
+        fields.
+    :param lat: Latitude of the center of the circle.
+    :param lng: Longitude of the center of the circle.
+    :param radius: Radius of the circle, in meters.
+    :return: A peewee expression.
+    """
+    return (
+        bbox_filter(model, radius_to_bbox(lat, lng, radius)) &
+        (distance_expression(model, lat, lng) <= radius * radius)
+    )
+
+
+def _check_coordinates(coordinates, depth):
+    """
+    Check the coordinates of a GeoJSON geometry are nested lists of numbers,
+    of the given depth.
+    """
+    if not isinstance(coordinates, list):
+        return False
+    if depth == 1:
+        return len(coordinates) >= 2 and all(
+            isinstance(x, numbers.Real) and not isinstance(x, bool)
+            for x in coordinates
+        )
+    return all(_check_coordinates(x, depth - 1) for x in coordinates)
+
+
+def normalize_geojson_geometry(value):
+    """
+    Validate a GeoJSON geometry and serialize it in a canonical way, so that
+    it can be output verbatim afterwards.
+
+    :param value: A GeoJSON geometry, as a JSON string or a dict.
+    :return: The geometry, as a JSON string.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError("Invalid GeoJSON geometry, invalid JSON.")
+    if not isinstance(value, dict):
+        raise ValueError("Invalid GeoJSON geometry, expected an object.")
+    depth = GEOJSON_COORDINATES_DEPTH.get(value.get('type'))
+    if depth is None:
+        raise ValueError("Invalid GeoJSON geometry type.")
+    if not _check_coordinates(value.get('coordinates'), depth):
+        raise ValueError("Invalid GeoJSON geometry coordinates.")
+    return json.dumps({
+        'type': value['type'],
+        'coordinates': value['coordinates'],
+    })
+
+
+def _iter_positions(coordinates, depth):
+    """
+    Iterate over the positions of the coordinates of a GeoJSON geometry, of
+    the given depth.
+    """
+    if depth == 1:
+        yield coordinates
+    else:
+        for x in coordinates:
+            yield from _iter_positions(x, depth - 1)
+
+
+def shape_extent(shape_geojson, lat, lng):
+    """
+    Compute how far a shape extends away from a position.
+
+    :param shape_geojson: A GeoJSON geometry, as a JSON string (see
+        ``normalize_geojson_geometry``), or ``None``.
+    :param lat: Latitude of the position.
+    :param lng: Longitude of the position.
+    :return: The largest difference of latitude or longitude between the
+        position and the points of the shape, in degrees, or ``None`` if
+        there is no shape.
+    """
+    if not shape_geojson:
+        return None
+    geometry = json.loads(shape_geojson)
+    depth = GEOJSON_COORDINATES_DEPTH[geometry['type']]
+    extent = 0.0
+    for position in _iter_positions(geometry['coordinates'], depth):
+        extent = max(extent, abs(position[0] - lng), abs(position[1] - lat))
+    return extent
+
+
+def shapes_bbox_filter(model, bbox):
+    """
+    Build a filter on the items whose position or shape may cross a bounding
+    box.
+
+    Items whose shape extends less than ``TILES_SHAPE_MARGIN`` away from their
+    position are looked up through the spatial index, the others through the
+    index on their shape extent.
+
+    :param model: Database model with ``lat``, ``lng``, ``grid_cell`` and
+        ``shape_extent`` fields.
+    :param bbox: A tuple ``(min_lng, min_lat, max_lng, max_lat)``.
+    :return: A peewee expression.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    extent = model.shape_extent
+    large_shape_filter = (
+        # Bounded range, so that the database estimates it as selective
+        extent.between(TILES_SHAPE_MARGIN, 360) &
+        (model.lat + extent >= min_lat) &
+        (model.lat - extent <= max_lat) &
+        (model.lng + extent >= min_lng) &
+        (model.lng - extent <= max_lng)
+    )
+    expanded_bbox = expand_bbox(bbox, TILES_SHAPE_MARGIN)
+    # Same as bbox_filter(model, expanded_bbox) | large_shape_filter, with
+    # the alternatives at the top level so that the database can look up
+    # each of them through an index
+    return (
+        (_cells_filter(model, expanded_bbox) | large_shape_filter) &
+        (_position_filter(model, expanded_bbox) | large_shape_filter)
+    )
+
+
+def tile_bbox(zoom, x, y):
+    """
+    Compute the bounding box of a map tile, in the XYZ tiles scheme used by
+    Leaflet and OpenStreetMap.
+
+    :param zoom: Zoom level of the tile.
+    :param x: Column of the tile.
+    :param y: Row of the tile.
+    :return: A tuple ``(min_lng, min_lat, max_lng, max_lat)``.
+    """
+    nb_tiles = 2 ** zoom
+
+    def tile_lat(row):
+        return math.degrees(
+            math.atan(math.sinh(math.pi * (1 - 2.0 * row / nb_tiles)))
+        )
+
+    return (
+        x * 360.0 / nb_tiles - 180, tile_lat(y + 1),
+        (x + 1) * 360.0 / nb_tiles - 180, tile_lat(y)
+    )
+
+
+def cluster_cell(lat, lng, zoom):
+    """
+    Get the cluster cell containing a point, at a given zoom level.
+
+    Cells split each map tile (see ``tile_bbox``) in a regular grid of
+    ``CLUSTERS_PER_TILE`` rows and columns, so that clusters have the same
+    size on screen at any latitude.
+
+    :param lat: Latitude of the point.
+    :param lng: Longitude of the point.
+    :param zoom: Zoom level.
+    :return: A tuple ``(row, column)``.
+    """
+    nb_cells = 2 ** zoom * CLUSTERS_PER_TILE
+    # Clamp latitude to the limits of the Web Mercator projection
+    lat = math.radians(max(min(lat, 85.0511), -85.0511))
+    return (
+        min(int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * nb_cells),
+            nb_cells - 1),
+        min(int((lng + 180) / 360.0 * nb_cells), nb_cells - 1)
+    )
+
+
+def expand_bbox(bbox, margin):
+    """
+    Expand a bounding box by a margin on each side.
+
+    :param bbox: A tuple ``(min_lng, min_lat, max_lng, max_lat)``.
+    :param margin: The margin, in degrees.
+    :return: The expanded bounding box, limited to valid coordinates.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return (
+        max(min_lng - margin, -180), max(min_lat - margin, -90),
+        min(max_lng + margin, 180), min(max_lat + margin, 90)
+    )
+
+
+def _point_in_bbox(point, bbox):
+    """
+    Check whether a point ``[lng, lat]`` is in a bounding box.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return min_lng <= point[0] <= max_lng and min_lat <= point[1] <= max_lat
+
+
+def _clip_segment(start, end, bbox):
+    """
+    Clip a segment to a bounding box, using Liang-Barsky algorithm.
+
+    :return: ``None`` if the segment is outside of the bounding box, or a
+        tuple of the clipped start and end points and of the parameters
+        (between 0 and 1) of these points on the segment.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    delta_lng, delta_lat = end[0] - start[0], end[1] - start[1]
+    t_start, t_end = 0.0, 1.0
+    for p, q in (
+        (-delta_lng, start[0] - min_lng), (delta_lng, max_lng - start[0]),
+        (-delta_lat, start[1] - min_lat), (delta_lat, max_lat - start[1]),
+    ):
+        if p == 0:
+            if q < 0:
+                # Parallel to this edge and outside
+                return None
+            continue
+        t = float(q) / p
+        if p < 0:
+            if t > t_end:
+                return None
+            t_start = max(t_start, t)
+        else:
+            if t < t_start:
+                return None
+            t_end = min(t_end, t)
+    return (
+        [start[0] + t_start * delta_lng, start[1] + t_start * delta_lat],
+        [start[0] + t_end * delta_lng, start[1] + t_end * delta_lat],
+        t_start, t_end
+    )
+
+
+def _clip_line(coordinates, bbox):
+    """
+    Clip a line to a bounding box.
+
+    :return: A list of the lines (lists of points) inside the bounding box.
+    """
+    lines, current = [], None
+    for start, end in zip(coordinates, coordinates[1:]):
+        segment = _clip_segment(start, end, bbox)
+        if segment is None:
+            current = None
+            continue
+        clipped_start, clipped_end, t_start, t_end = segment
+        if current is None or t_start > 0:
+            # Entering the bounding box
+            current = [clipped_start]
+            lines.append(current)
+        current.append(clipped_end)
+        if t_end < 1:
+            # Leaving the bounding box
+            current = None
+    return lines
+
+
+def _clip_ring(ring, bbox):
+    """
+    Clip a polygon ring to a bounding box, using Sutherland-Hodgman
+    algorithm.
+
+    :return: The clipped (closed) ring or ``None`` if it is outside of the
+        bounding box.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    points = [list(point[:2]) for point in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+    # Edges of the bounding box, as (axis, value, whether inside is above)
+    for axis, value, is_above in (
+        (0, min_lng, True), (0, max_lng, False),
+        (1, min_lat, True), (1, max_lat, False),
+    ):
+        if not points:
+            break
+        clipped = []
+        for index, current in enumerate(points):
+            previous = points[index - 1]
+            current_inside = (current[axis] >= value) == is_above
+            previous_inside = (previous[axis] >= value) == is_above
+            if current_inside != previous_inside:
+                # Add the intersection with the edge
+                t = float(value - previous[axis]) / (
+                    current[axis] - previous[axis]
+                )
+                intersection = [
+                    previous[0] + t * (current[0] - previous[0]),
+                    previous[1] + t * (current[1] - previous[1])
+                ]
+                intersection[axis] = value
+                clipped.append(intersection)
+            if current_inside:
+                clipped.append(current)
+        points = clipped
+    if len(points) < 3:
+        return None
+    return points + [points[0]]
+
+
+def _clip_polygon(rings, bbox):
+    """
+    Clip a polygon, given by its rings, to a bounding box.
+
+    :return: The clipped rings or ``None`` if the polygon is outside of the
+        bounding box.
+    """
+    exterior = _clip_ring(rings[0], bbox) if rings else None
+    if exterior is None:
+        return None
+    holes = [_clip_ring(ring, bbox) for ring in rings[1:]]
+    return [exterior] + [hole for hole in holes if hole is not None]
+
+
+def clip_geometry(geometry, bbox):
+    """
+    Clip a GeoJSON geometry to a bounding box.
+
+    :param geometry: A GeoJSON geometry, as a dict.
+    :param bbox: A tuple ``(min_lng, min_lat, max_lng, max_lat)``.
+    :return: The clipped GeoJSON geometry, as a dict, or ``None`` if the
+        geometry does not intersect the bounding box.
+    """
+    geometry_type = geometry['type']
+    coordinates = geometry['coordinates']
+    if geometry_type == 'Point':
+        if _point_in_bbox(coordinates, bbox):
+            return geometry
+        return None
+    elif geometry_type == 'MultiPoint':
+        points = [x for x in coordinates if _point_in_bbox(x, bbox)]
+        if points:
+            return {'type': 'MultiPoint', 'coordinates': points}
+        return None
+    elif geometry_type in ['LineString', 'MultiLineString']:
+        if geometry_type == 'LineString':
+            coordinates = [coordinates]
+        lines = []
+        for line in coordinates:
+            lines.extend(_clip_line(line, bbox))
+        if not lines:
+            return None
+        if len(lines) == 1:
+            return {'type': 'LineString', 'coordinates': lines[0]}
+        return {'type': 'MultiLineString', 'coordinates': lines}
+    elif geometry_type in ['Polygon', 'MultiPolygon']:
+        if geometry_type == 'Polygon':
+            coordinates = [coordinates]
+        polygons = [_clip_polygon(polygon, bbox) for polygon in coordinates]
+        polygons = [polygon for polygon in polygons if polygon is not None]
+        if not polygons:
+            return None
+        if len(polygons) == 1:
+            return {'type': 'Polygon', 'coordinates': polygons[0]}
+        return {'type': 'MultiPolygon', 'coordinates': polygons}
+    raise ValueError("Invalid GeoJSON geometry type.")
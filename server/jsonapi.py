@@ -4,14 +4,39 @@
 Helpers to implement a JSON API with Bottle.
 """
 import arrow
+import base64
 import datetime
+import collections
 import json
+import operator
 import re
+import threading
 
 import bottle
 import peewee
 
+from server import geo
+
+# Number of items serialized together in a single chunk of a streamed
+# response
+STREAM_CHUNK_SIZE = 100
 FILTER_RE = re.compile(r"filter\[([A-z0-9_]+?)\](\[([A-z0-9_]+\??)\])?")
+# Filters on the position of the items, not matching a model field
+GEO_FILTERS = ['bbox', 'near', 'radius']
+FILTER_OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'lt': operator.lt,
+    'le': operator.le,
+}
+# Number of compiled query plans kept, see JsonApiCompileQuery
+QUERY_PLANS_MAX_ENTRIES = 256
+
+# Compiled query plans, by shape of query, in LRU order
+_query_plans = collections.OrderedDict()
+_query_plans_lock = threading.Lock()
 
 
 class DateAwareJSONEncoder(json.JSONEncoder):
@@ -56,10 +81,269 @@ def JsonApiError(error_code, error_str):
 
 
 
+def JsonApiStreamList(head, items, tail, encoded=False):
+    """
+    Serialize a JSON document holding a list of items incrementally, so that
+    the whole document never has to be held in memory.
+
+    :param head: JSON string to output before the list of items, ending with
+        the opening bracket of the list.
+    :param items: An iterable of JSON-serializable items.
+    :param tail: JSON string to output after the list of items, starting
+        with the closing bracket of the list. Can also be a function
+        returning this string, called once all the items are output.
+    :param encoded: Whether the items are already serialized as JSON strings.
+    :returns: A generator of JSON strings.
+    """
+    encoder = DateAwareJSONEncoder()
+    chunk = []
+    separator = ''
+    yield head
+    for item in items:
+        chunk.append(item if encoded else encoder.encode(item))
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield separator + ', '.join(chunk)
+            chunk = []
+            separator = ', '
+    if chunk:
+        yield separator + ', '.join(chunk)
+    yield tail() if callable(tail) else tail
+
+
+def _parse_datetime(value):
+    """
+    Parse an ISO 8601 datetime filter value, as a naive datetime.
+    """
+    try:
+        # Much faster than arrow, for the common formats
+        return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+    except ValueError:
+        return arrow.get(value).naive
+
+
+def _indexed_fields(model):
+    """
+    Get the fields of a model which can be looked up through an index, that
+    is the fields leading an index.
+
+    :param model: Database model.
+    :return: A set of field names.
+    """
+    names = set(
+        field.name for field in model._meta.sorted_fields
+        if field.primary_key or field.index or field.unique
+    )
+    for index in model._meta.indexes:
+        if isinstance(index, (list, tuple)) and index[0]:
+            names.add(index[0][0])
+    return names
+
+
+class JsonApiQueryPlan(object):
+    """
+    Filters and sorting of a query, resolved against a model once per shape
+    of query (see ``JsonApiCompileQuery``), to be bound to the values of each
+    query.
+    """
+    def __init__(self, model, filters, sorting):
+        """
+        :param model: Database model used in this query.
+        :param filters: A list of tuples of the query param of each filter,
+            the geographical filter name (``None`` for a filter on a field),
+            the field, the function converting values to the type of the
+            field, the operator function and whether fields without value
+            match.
+        :param sorting: A list of tuples of the field to sort on (``None`` for
+            the distance to the ``near`` filter point) and whether sorting is
+            descending.
+        """
+        self.model = model
+        self.filters = filters
+        self.sorting = sorting
+
+    def bind(self, query):
+        """
+        Build the filters and sorting for the values of a query.
+
+        :param query: A Bottle query dict, of the shape of this plan.
+        :return: A tuple of filters and sorting to apply.
+        """
+        filters = []
+        near, radius = None, None
+        for param, geo_filter, field, convert, operation, nullable in (
+            self.filters
+        ):
+            if geo_filter == 'bbox':
+                for value in query.getall(param):
+                    filters.append(
+                        geo.bbox_filter(self.model, geo.parse_bbox(value))
+                    )
+            elif geo_filter == 'near':
+                near = geo.parse_point(query[param])
+            elif geo_filter == 'radius':
+                try:
+                    radius = float(query[param])
+                    assert radius > 0
+                except (AssertionError, ValueError):
+                    raise ValueError("Invalid radius provided.")
+            else:
+                for value in query.getall(param):
+                    operation_filter = operation(field, convert(value))
+                    if nullable:
+                        operation_filter = (field == None) | operation_filter
+                    filters.append(operation_filter)
+
+        if radius is not None:
+            filters.append(
+                geo.radius_filter(self.model, near[0], near[1], radius)
+            )
+
+        sorting = []
+        for sort_field, descending in self.sorting:
+            if sort_field is None:
+                # Sort by distance to the near filter point
+                sort_field = geo.distance_expression(self.model, *near)
+            sorting.append(sort_field.desc() if descending else sort_field)
+        return filters, sorting
+
+
+def _compile_query(filter_params, sort, model, default_sorting):
+    """
+    Resolve the filters and sorting of a query, see ``JsonApiCompileQuery``.
+    """
+    # Handle filtering according to JSON API spec
+    filters = []
+    indexed_fields = _indexed_fields(model)
+    is_indexed = False
+    unindexed_field_name = None
+    geo_filters = set()
+    for param in filter_params:
+        filter_match = FILTER_RE.match(param)
+        if not filter_match:
+            continue
+        field_name = filter_match.group(1)
+
+        # Handle geographical filters
+        if field_name in GEO_FILTERS:
+            if not all(
+                x in model._meta.fields for x in ['lat', 'lng', 'grid_cell']
+            ):
+                raise ValueError(
+                    "Invalid filtering key provided: {}.".format(field_name)
+                )
+            filters.append((param, field_name, None, None, None, False))
+            geo_filters.add(field_name)
+            # Geographical filters use the spatial index
+            is_indexed = True
+            continue
+
+        field = model._meta.fields.get(field_name)
+        if field is None:
+            raise ValueError(
+                "Invalid filtering key provided: {}.".format(field_name)
+            )
+        if field_name in indexed_fields:
+            is_indexed = True
+        elif unindexed_field_name is None:
+            unindexed_field_name = field_name
+
+        if isinstance(field, peewee.DateTimeField):
+            convert = _parse_datetime
+        elif isinstance(field, peewee.DoubleField):
+            convert = float
+        elif isinstance(field, peewee.IntegerField):
+            convert = int
+        else:
+            convert = str
+
+        # Handle operation, default operation is 'eq'
+        operation = filter_match.group(3) or 'eq'
+        # Handle '?' modifier
+        nullable = operation.endswith('?')
+        operation = FILTER_OPERATORS.get(operation.rstrip('?'))
+        if operation is None:
+            raise ValueError("Invalid filtering operator provided.")
+        filters.append((param, None, field, convert, operation, nullable))
+
+    if unindexed_field_name is not None and not is_indexed:
+        # The query would scan the whole table
+        raise ValueError(
+            "Invalid filtering key provided: {}, filters on this field "
+            "require a filter on an indexed field.".format(
+                unindexed_field_name
+            )
+        )
+    if 'radius' in geo_filters and 'near' not in geo_filters:
+        raise ValueError("Radius filter requires a near filter.")
+
+    # Handle sorting according to JSON API spec
+    sorting = []
+    if sort is not None:
+        for index in sort.split(','):
+            field_name = index.lstrip('-')
+            if field_name == 'distance' and 'near' in geo_filters:
+                sort_field = None
+            else:
+                sort_field = model._meta.fields.get(field_name)
+                if sort_field is None:
+                    raise ValueError(
+                        "Invalid sorting key provided: {}.".format(index)
+                    )
+            sorting.append((sort_field, index.startswith('-')))
+    # Default sorting options
+    if not sorting and default_sorting:
+        sort_field = model._meta.fields.get(default_sorting)
+        if sort_field is None:
+            raise ValueError(
+                "Invalid default sorting key provided: {}.".format(
+                    default_sorting
+                )
+            )
+        sorting.append((sort_field, False))
+
+    return JsonApiQueryPlan(model, filters, sorting)
+
+
+def JsonApiCompileQuery(query, model, default_sorting=None):
+    """
+    Get the plan of the filters and sorting of a query, from the cache of
+    plans if a query of the same shape (filter params, sorting, model and
+    default sorting) was compiled before.
+
+    :param query: A Bottle query dict.
+    :param model: Database model used in this query.
+    :param default_sorting: Optional field to sort on if no sort options are
+        passed through parameters.
+    :return: A ``JsonApiQueryPlan``.
+    """
+    filter_params = tuple(
+        param for param in query if param.startswith('filter[')
+    )
+    key = (model, filter_params, query.get('sort'), default_sorting)
+    with _query_plans_lock:
+        plan = _query_plans.get(key)
+        if plan is not None:
+            _query_plans.move_to_end(key)
+            return plan
+
+    # Invalid queries raise and are not cached
+    plan = _compile_query(
+        filter_params, query.get('sort'), model, default_sorting
+    )
+    with _query_plans_lock:
+        _query_plans[key] = plan
+        while len(_query_plans) > QUERY_PLANS_MAX_ENTRIES:
+            _query_plans.popitem(last=False)
+    return plan
+
+
 def JsonApiParseQuery(query, model, default_sorting=None):
     """
     Implementing JSON API spec for filtering, sorting and paginating results.
 
+    Filters on fields which are not indexed are only accepted along with a
+    filter on an indexed field (or a geographical filter).
+
     :param query: A Bottle query dict.
     :param model: Database model used in this query.
     :param default_sorting: Optional field to sort on if no sort options are
@@ -67,53 +351,9 @@ def JsonApiParseQuery(query, model, default_sorting=None):
     :return: A tuple of filters, page number, page size (items per page) and
         sorting to apply.
     """
-    # Handle filtering according to JSON API spec
-    filters = []
-    for param in query:
-        filter_match = FILTER_RE.match(param)
-        if not filter_match:
-            continue
-        field = getattr(model, filter_match.group(1))
-
-        for value in query.getall(param):
-            if isinstance(field, peewee.DateTimeField):
-                value = arrow.get(value).naive
-            elif isinstance(field, peewee.DoubleField):
-                value = float(value)
-            elif isinstance(field, peewee.IntegerField):
-                value = int(value)
-
-            # Handle operation
-            operation = filter_match.group(3)
-            if operation is None:
-                # Default operation is 'eq'
-                operation = 'eq'
-
-            # Handle '?' modifier
-            modifier_filter = None
-            if operation.endswith('?'):
-                modifier_filter = (field == None)
-                operation = operation.rstrip('?')
-
-            if operation == 'eq':
-                operation_filter = (field == value)
-            elif operation == 'ne':
-                operation_filter = (field != value)
-            elif operation == 'gt':
-                operation_filter = (field > value)
-            elif operation == 'ge':
-                operation_filter = (field >= value)
-            elif operation == 'lt':
-                operation_filter = (field < value)
-            elif operation == 'le':
-                operation_filter = (field <= value)
-            else:
-                raise ValueError("Invalid filtering operator provided.")
-
-            if modifier_filter:
-                filters.append(modifier_filter | operation_filter)
-            else:
-                filters.append(operation_filter)
+    filters, sorting = JsonApiCompileQuery(
+        query, model, default_sorting
+    ).bind(query)
 
     # Handle pagination according to JSON API spec
     page_number, page_size = 0, None
@@ -127,28 +367,147 @@ def JsonApiParseQuery(query, model, default_sorting=None):
     except (AssertionError, ValueError):
         raise ValueError("Invalid pagination provided.")
 
-    # Handle sorting according to JSON API spec
-    sorting = []
-    if 'sort' in query:
-        for index in query['sort'].split(','):
-            try:
-                sort_field = getattr(model, index.lstrip('-'))
-            except AttributeError:
-                raise ValueError(
-                    "Invalid sorting key provided: {}.".format(index)
-                )
-            if index.startswith('-'):
-                sort_field = sort_field.desc()
-            sorting.append(sort_field)
-    # Default sorting options
-    if not sorting and default_sorting:
-        try:
-            sorting.append(getattr(model, default_sorting))
-        except AttributeError:
+    return filters, page_number, page_size, sorting
+
+
+def JsonApiParseFields(query, resource_type, fields):
+    """
+    Implementing JSON API spec for sparse fieldsets
+    (http://jsonapi.org/format/#fetching-sparse-fieldsets).
+
+    :param query: A Bottle query dict.
+    :param resource_type: Type of the resources, as in ``fields[TYPE]``.
+    :param fields: List of the fields which can be requested, in output
+        order.
+    :return: The list of fields to output, or ``None`` if no sparse fieldset
+        was requested.
+    """
+    param = 'fields[{}]'.format(resource_type)
+    if param not in query:
+        return None
+
+    requested = [x.strip() for x in query[param].split(',') if x.strip()]
+    available = [field.name for field in fields]
+    for name in requested:
+        if name not in available:
             raise ValueError(
-                "Invalid default sorting key provided: {}.".format(
-                    default_sorting
+                "Invalid sparse fieldset key provided: {}.".format(name)
+            )
+    return [field for field in fields if field.name in requested]
+
+
+def JsonApiEncodePageCursor(values):
+    """
+    Encode an opaque pagination cursor.
+
+    :param values: The values of the sorting keys of an item.
+    :return: The cursor, as a URL-safe string.
+    """
+    payload = json.dumps(values, cls=DateAwareJSONEncoder)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def JsonApiDecodePageCursor(cursor, keys):
+    """
+    Decode an opaque pagination cursor.
+
+    :param cursor: The cursor, as built by ``JsonApiEncodePageCursor``.
+    :param keys: The sorting keys, as returned by ``JsonApiParsePageCursor``.
+    :return: The values of the sorting keys.
+    """
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        )
+        assert isinstance(values, list) and len(values) == len(keys)
+        return [
+            arrow.get(value).naive
+            if isinstance(field, peewee.DateTimeField) else value
+            for (field, _), value in zip(keys, values)
+        ]
+    except (AssertionError, TypeError, ValueError):
+        raise ValueError("Invalid pagination cursor provided.")
+
+
+def JsonApiParsePageCursor(query, model, sorting):
+    """
+    Implementing keyset pagination, through ``page[after]`` and
+    ``page[before]`` opaque cursors. Unlike ``page[number]``, the cost of
+    fetching a page does not depend on its position.
+
+    :param query: A Bottle query dict.
+    :param model: Database model used in this query.
+    :param sorting: Sorting to apply, as returned by ``JsonApiParseQuery``.
+    :return: A tuple of filters and sorting to apply, sorting keys (a list of
+        tuples of a field and whether it is sorted in descending order, or
+        ``None`` if results are not sorted or if sorting does not allow
+        keyset pagination) and whether the results should be reversed.
+    """
+    has_cursor = 'page[after]' in query or 'page[before]' in query
+    if has_cursor and 'page[number]' in query:
+        raise ValueError(
+            "Invalid pagination provided, page[number] cannot be used with "
+            "a cursor."
+        )
+    if 'page[after]' in query and 'page[before]' in query:
+        raise ValueError(
+            "Invalid pagination provided, page[after] and page[before] "
+            "cannot be used together."
+        )
+
+    if not sorting and not has_cursor:
+        # Unsorted results
+        return [], sorting, None, False
+
+    # Sorting keys, made unique by the primary key
+    keys = []
+    for sort_field in sorting:
+        descending = isinstance(sort_field, peewee.Ordering)
+        if descending:
+            descending = sort_field.direction == 'DESC'
+            sort_field = sort_field.node
+        if not isinstance(sort_field, peewee.Field) or sort_field.null:
+            if has_cursor:
+                raise ValueError(
+                    "Invalid pagination provided, sorting does not allow "
+                    "cursors."
                 )
+            return [], sorting, None, False
+        keys.append((sort_field, descending))
+    primary_key = model._meta.primary_key
+    if not any(field.name == primary_key.name for field, _ in keys):
+        keys.append((primary_key, False))
+        sorting = sorting + [primary_key]
+
+    if not has_cursor:
+        return [], sorting, keys, False
+
+    reverse = 'page[before]' in query
+    if reverse:
+        values = JsonApiDecodePageCursor(query['page[before]'], keys)
+    else:
+        values = JsonApiDecodePageCursor(query['page[after]'], keys)
+
+    # Items strictly after (or before) the cursor, in sorting order
+    cursor_filter = None
+    for index, (field, descending) in enumerate(keys):
+        if descending != reverse:
+            condition = (field < values[index])
+        else:
+            condition = (field > values[index])
+        for previous_index in range(index):
+            condition = condition & (
+                keys[previous_index][0] == values[previous_index]
             )
+        if cursor_filter is None:
+            cursor_filter = condition
+        else:
+            cursor_filter = cursor_filter | condition
 
-    return filters, page_number, page_size, sorting
+    if reverse:
+        # Fetch the items before the cursor in reverse order
+        sorting = [
+            field.asc() if descending else field.desc()
+            for field, descending in keys
+        ]
+    return [cursor_filter], sorting, keys, reverse
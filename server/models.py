@@ -3,22 +3,70 @@
 """
 Models and database definition
 """
+import datetime
 import json
 import os
+import sqlite3
+from urllib.parse import urlparse
 
 import bottle
 import peewee
 from playhouse.db_url import connect
 from playhouse.shortcuts import model_to_dict
 
+from server import geo
 from server.tools import UTC_now
 
-db = connect(os.environ.get('DATABASE', 'sqlite:///reports.db'))
+# URL of the database, see playhouse.db_url. Connections are pooled by
+# default, using "+pool" schemes.
+DATABASE = os.environ.get('DATABASE', 'sqlite+pool:///reports.db')
+# Pragmas of the SQLite connections. In WAL mode, readers do not block the
+# writer (typically the importers) and conversely, and syncing only on
+# checkpoints (synchronous=NORMAL) is safe.
+SQLITE_PRAGMAS = [
+    ('journal_mode', os.environ.get('SQLITE_JOURNAL_MODE', 'wal')),
+    ('synchronous', 'normal'),
+    # Negative values are in KiB
+    ('cache_size', -int(os.environ.get('SQLITE_CACHE_SIZE', '16384'))),
+    ('mmap_size', int(os.environ.get('SQLITE_MMAP_SIZE', '67108864'))),
+    # Wait for locks to be released (in ms) instead of failing
+    ('busy_timeout', int(os.environ.get('SQLITE_BUSY_TIMEOUT', '5000'))),
+]
+
+
+def _connect(url):
+    """
+    Create the database from its URL, applying ``SQLITE_PRAGMAS`` to SQLite
+    databases.
+
+    :param url: URL of the database.
+    :return: A peewee database.
+    """
+    kwargs = {}
+    scheme = urlparse(url).scheme
+    if scheme.split('+')[0] == 'sqlite':
+        kwargs['pragmas'] = SQLITE_PRAGMAS
+        if scheme.endswith('+pool'):
+            # Pooled connections are handed from thread to thread, one
+            # thread using them at a time
+            kwargs['check_same_thread'] = False
+        # Transactions take the write lock when they begin, so that
+        # concurrent writers wait for each other instead of failing to
+        # upgrade a read lock
+        kwargs['lock_type'] = 'IMMEDIATE'
+        kwargs['returning_clause'] = sqlite3.sqlite_version_info >= (3, 35)
+    return connect(url, **kwargs)
+
+
+db = _connect(DATABASE)
 
 
 @bottle.hook('before_request')
 def _connect_db():
-    db.connect()
+    # CORS preflight requests do not use the database
+    if bottle.request.method == 'OPTIONS':
+        return
+    db.connect(reuse_if_open=True)
 
 
 @bottle.hook('after_request')
@@ -27,6 +75,25 @@ def _close_db():
         db.close()
 
 
+def stream_with_db(chunks):
+    """
+    Wrap a streamed response body which reads from the database.
+
+    Streamed bodies are consumed after the ``after_request`` hooks ran, so
+    the database connection has to be kept open until the end of the stream.
+
+    :param chunks: An iterable of chunks of the response body.
+    :returns: A generator of the chunks of the response body.
+    """
+    db.connect(reuse_if_open=True)
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        if not db.is_closed():
+            db.close()
+
+
 class BaseModel(peewee.Model):
     """
     Common base class for all models
@@ -35,6 +102,266 @@ class BaseModel(peewee.Model):
         database = db
 
 
+class Counter(BaseModel):
+    """
+    A named counter, shared by all the processes using the database
+    """
+    name = peewee.CharField(max_length=255, primary_key=True)
+    value = peewee.BigIntegerField(default=0)
+    datetime = peewee.DateTimeField(
+        default=UTC_now,
+        null=True
+    )
+
+
+# Name of the counter incremented on every change to the reports
+DATA_VERSION_COUNTER = 'data_version'
+# Names of the counters holding the stats about the reports, see
+# get_reports_stats:
+# the total number of reports (including archived ones), the number of
+# reports not expired at the datetime of the counter, the datetime of the
+# last report and the number of archived reports.
+NB_REPORTS_COUNTER = 'nb_reports'
+NB_ACTIVE_REPORTS_COUNTER = 'nb_active_reports'
+LAST_REPORT_COUNTER = 'last_report'
+NB_ARCHIVED_REPORTS_COUNTER = 'nb_archived_reports'
+STATS_COUNTERS = [
+    NB_REPORTS_COUNTER, NB_ACTIVE_REPORTS_COUNTER, LAST_REPORT_COUNTER,
+    NB_ARCHIVED_REPORTS_COUNTER
+]
+# Reports with at least this number of downvotes are no longer shown. Same as
+# in src/constants.js
+REPORT_DOWNVOTES_THRESHOLD = 1
+# Maximum number of reports archived per transaction, see archive_reports
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '500'))
+# Maximum number of reports inserted per transaction, see create_reports
+CREATE_BATCH_SIZE = int(os.environ.get('CREATE_BATCH_SIZE', '100'))
+
+
+def bump_data_version():
+    """
+    Increment the data version counter. Should be called in the same
+    transaction as any write to the reports.
+
+    :return: The new data version.
+    """
+    with db.atomic():
+        updated = Counter.update(
+            value=Counter.value + 1,
+            datetime=UTC_now()
+        ).where(Counter.name == DATA_VERSION_COUNTER).execute()
+        if not updated:
+            Counter.create(name=DATA_VERSION_COUNTER, value=1)
+        return get_data_version()[0]
+
+
+def get_data_version():
+    """
+    Get the current data version.
+
+    :return: A tuple of the data version and the datetime of the last change
+        to the data (``None`` if there was no change yet).
+    """
+    counter = Counter.get_or_none(Counter.name == DATA_VERSION_COUNTER)
+    if counter is None:
+        return 0, None
+    return counter.value, counter.datetime
+
+
+def _is_active(expiration_datetime, now):
+    """
+    Check whether a report with the given expiration datetime is active
+    (not expired) at a given datetime.
+    """
+    return expiration_datetime is None or expiration_datetime > now
+
+
+def init_stats(now=None):
+    """
+    Compute the stats counters from the reports. Should only be called once,
+    as it requires full scans of the reports table. Counters are then
+    maintained by ``update_stats`` and ``sweep_expired_reports``.
+
+    :param now: Optional naive UTC datetime to count active reports at.
+    :return: A dict of the stats counters, by name.
+    """
+    if now is None:
+        now = UTC_now()
+    with db.atomic():
+        last_report_datetime = max([
+            x for x in [
+                Report.select(peewee.fn.MAX(Report.datetime)).scalar(),
+                ArchivedReport.select(
+                    peewee.fn.MAX(ArchivedReport.datetime)
+                ).scalar()
+            ]
+            if x is not None
+        ] or [None])
+        nb_archived_reports = ArchivedReport.select().count()
+        counters = {
+            NB_REPORTS_COUNTER: (
+                Report.select().count() + nb_archived_reports, now
+            ),
+            NB_ACTIVE_REPORTS_COUNTER: (
+                Report.select().where(
+                    (Report.expiration_datetime == None) |
+                    (Report.expiration_datetime > now)
+                ).count(),
+                now
+            ),
+            LAST_REPORT_COUNTER: (0, last_report_datetime),
+            NB_ARCHIVED_REPORTS_COUNTER: (nb_archived_reports, now),
+        }
+        Counter.delete().where(Counter.name << STATS_COUNTERS).execute()
+        for name, (value, counter_datetime) in counters.items():
+            Counter.create(name=name, value=value, datetime=counter_datetime)
+        return _get_stats_counters()
+
+
+def _get_stats_counters():
+    """
+    Get the stats counters.
+
+    :return: A dict of the stats counters, by name, or ``None`` if they were
+        not computed yet.
+    """
+    counters = {
+        counter.name: counter
+        for counter in Counter.select().where(Counter.name << STATS_COUNTERS)
+    }
+    if len(counters) != len(STATS_COUNTERS):
+        return None
+    return counters
+
+
+def update_stats(reports, is_new, previous_expiration_datetimes=None):
+    """
+    Update the stats counters for reports about to be written. Should be
+    called in the same transaction as the write.
+
+    :param reports: The list of reports about to be written.
+    :param is_new: Whether the reports are about to be inserted.
+    :param previous_expiration_datetimes: For existing reports, the list of
+        their expiration datetimes currently stored in the database.
+    """
+    while True:
+        counters = _get_stats_counters()
+        if counters is None:
+            counters = init_stats()
+        active_counter = counters[NB_ACTIVE_REPORTS_COUNTER]
+
+        # Active reports are counted at the datetime of the last sweep
+        delta = sum(
+            int(_is_active(
+                report.expiration_datetime, active_counter.datetime
+            ))
+            for report in reports
+        )
+        if not is_new:
+            delta -= sum(
+                int(_is_active(expiration_datetime, active_counter.datetime))
+                for expiration_datetime in previous_expiration_datetimes
+            )
+        if not delta:
+            break
+        updated = Counter.update(value=Counter.value + delta).where(
+            (Counter.name == NB_ACTIVE_REPORTS_COUNTER) &
+            (Counter.datetime == active_counter.datetime)
+        ).execute()
+        if updated:
+            break
+        # A sweep happened concurrently, count again
+
+    if is_new:
+        Counter.update(value=Counter.value + len(reports)).where(
+            Counter.name == NB_REPORTS_COUNTER
+        ).execute()
+    report_datetime = max(
+        [report.datetime for report in reports if report.datetime is not None]
+        or [None]
+    )
+    last_report_datetime = counters[LAST_REPORT_COUNTER].datetime
+    if (
+        report_datetime is not None and
+        (last_report_datetime is None or
+         report_datetime > last_report_datetime)
+    ):
+        Counter.update(datetime=report_datetime).where(
+            (Counter.name == LAST_REPORT_COUNTER) &
+            ((Counter.datetime == None) |
+             (Counter.datetime < report_datetime))
+        ).execute()
+
+
+def sweep_expired_reports(now=None):
+    """
+    Update the number of active reports, removing the reports which expired
+    since the last sweep. Only these reports are read from the database.
+
+    :param now: Optional naive UTC datetime to sweep until.
+    """
+    if now is None:
+        now = UTC_now()
+    with db.atomic():
+        counters = _get_stats_counters()
+        if counters is None:
+            init_stats(now)
+            return
+        last_sweep = counters[NB_ACTIVE_REPORTS_COUNTER].datetime
+        if last_sweep >= now:
+            return
+        nb_expired = Report.select().where(
+            (Report.expiration_datetime > last_sweep) &
+            (Report.expiration_datetime <= now)
+        ).count()
+        # Another process may have swept concurrently, in which case there
+        # is nothing left to do
+        Counter.update(
+            value=Counter.value - nb_expired,
+            datetime=now
+        ).where(
+            (Counter.name == NB_ACTIVE_REPORTS_COUNTER) &
+            (Counter.datetime == last_sweep)
+        ).execute()
+
+
+def get_reports_stats(now=None):
+    """
+    Get the stats about the reports, from the stats counters, without
+    writing to the database.
+
+    :param now: Optional naive UTC datetime to count active reports at.
+        Reports expired since the last sweep (see ``sweep_expired_reports``,
+        run periodically) are read from the database to count them out.
+    :return: A tuple of the total number of reports (including archived
+        ones), the number of active (not expired) reports, the datetime of
+        the last report (``None`` if there are no reports) and the number of
+        archived reports.
+    """
+    if now is None:
+        now = UTC_now()
+    # Not in a transaction, which would take the write lock. The counters
+    # are read at once, so that the active reports counter and the datetime
+    # of the last sweep match.
+    counters = _get_stats_counters()
+    if counters is None:
+        # Only happens on a new database, before the first sweep
+        counters = init_stats(now)
+    active_counter = counters[NB_ACTIVE_REPORTS_COUNTER]
+    nb_active_reports = active_counter.value
+    if active_counter.datetime < now:
+        nb_active_reports -= Report.select().where(
+            (Report.expiration_datetime > active_counter.datetime) &
+            (Report.expiration_datetime <= now)
+        ).count()
+    return (
+        counters[NB_REPORTS_COUNTER].value,
+        nb_active_reports,
+        counters[LAST_REPORT_COUNTER].datetime,
+        counters[NB_ARCHIVED_REPORTS_COUNTER].value
+    )
+
+
 class Report(BaseModel):
     """
     A report object
@@ -46,20 +373,68 @@ class Report(BaseModel):
         default=UTC_now
     )
     datetime = peewee.DateTimeField(
-        default=UTC_now
+        default=UTC_now,
+        index=True
     )
-    expiration_datetime = peewee.DateTimeField(null=True)
+    expiration_datetime = peewee.DateTimeField(null=True, index=True)
     upvotes = peewee.IntegerField(default=0)
     downvotes = peewee.IntegerField(default=0)
     source = peewee.CharField(max_length=255, default='')
     shape_geojson = peewee.TextField(default=None, null=True)
+    # Spatial index key, see server.geo.grid_cell
+    grid_cell = peewee.IntegerField(default=None, null=True, index=True)
+    # How far the shape extends away from the position, see
+    # server.geo.shape_extent
+    shape_extent = peewee.DoubleField(default=None, null=True, index=True)
+    # Data version of the last change to this report, see bump_data_version
+    change_seq = peewee.BigIntegerField(default=0, index=True)
+
+    class Meta:
+        indexes = (
+            # Lookup of the active reports of a given type, by the importers
+            (('type', 'expiration_datetime', 'downvotes'), False),
+        )
+
+    def _update_index_keys(self):
+        # Keep the spatial index keys in sync with the position and shape
+        try:
+            lat, lng = float(self.lat), float(self.lng)
+            self.grid_cell = geo.grid_cell(lat, lng)
+        except (OverflowError, TypeError, ValueError):
+            # Invalid positions are rejected by the database
+            self.grid_cell = self.shape_extent = None
+        else:
+            try:
+                self.shape_extent = geo.shape_extent(
+                    self.shape_geojson, lat, lng
+                )
+            except (KeyError, TypeError, ValueError):
+                # Not a normalized shape, only the position is indexed
+                self.shape_extent = None
+
+    def save(self, *args, **kwargs):
+        self._update_index_keys()
+        with db.atomic():
+            self.change_seq = bump_data_version()
+            is_new = (
+                self.get_id() is None or kwargs.get('force_insert', False)
+            )
+            previous_expiration_datetime = None
+            if not is_new:
+                previous_expiration_datetime = Report.select(
+                    Report.expiration_datetime
+                ).where(Report.id == self.get_id()).scalar()
+            update_stats([self], is_new, [previous_expiration_datetime])
+            return super(Report, self).save(*args, **kwargs)
 
     def to_json(self):
         return {
             "type": "reports",
             "id": self.id,
             "attributes": {
-                k: v for k, v in model_to_dict(self).items()
+                k: v for k, v in model_to_dict(
+                    self, exclude=REPORT_INTERNAL_FIELDS
+                ).items()
                 if k != "id"
             }
         }
@@ -68,7 +443,9 @@ class Report(BaseModel):
         properties = {
             "type": "reports",
         }
-        for k, v in model_to_dict(self).items():
+        for k, v in model_to_dict(
+            self, exclude=REPORT_INTERNAL_FIELDS
+        ).items():
             properties[k] = v
 
         geometry = None
@@ -84,3 +461,201 @@ class Report(BaseModel):
             "properties": properties,
             "geometry": geometry,
         }
+
+
+def _is_active_expression(expiration_datetime, now):
+    """
+    Build a SQL expression evaluating to 1 if a report with the given
+    expiration datetime is active at a given datetime, 0 otherwise.
+    """
+    if not isinstance(expiration_datetime, peewee.Node):
+        expiration_datetime = peewee.Value(expiration_datetime)
+    return peewee.Case(
+        None,
+        [(
+            (expiration_datetime.is_null()) | (expiration_datetime > now),
+            1
+        )],
+        0
+    )
+
+
+def update_report(id, **updates):
+    """
+    Update a report atomically, in a single ``UPDATE`` statement, instead of
+    reading and saving it. The data version, change sequence and stats
+    counters are updated in the same transaction.
+
+    :param id: Id of the report to update.
+    :param updates: New values of the fields, as values or SQL expressions
+        relative to the current values, for instance ``Report.upvotes + 1``.
+    :return: The updated report, or ``None`` if there is no such report.
+    """
+    with db.atomic() as transaction:
+        # First write of the transaction, serializing concurrent writers
+        updates['change_seq'] = bump_data_version()
+
+        if 'expiration_datetime' in updates:
+            counters = _get_stats_counters()
+            if counters is None:
+                counters = init_stats()
+            last_sweep = counters[NB_ACTIVE_REPORTS_COUNTER].datetime
+            # Active reports are counted at the datetime of the last sweep
+            delta = Report.select(
+                _is_active_expression(
+                    updates['expiration_datetime'], last_sweep
+                ) -
+                _is_active_expression(Report.expiration_datetime, last_sweep)
+            ).where(Report.id == id).scalar()
+            if delta:
+                Counter.update(value=Counter.value + delta).where(
+                    Counter.name == NB_ACTIVE_REPORTS_COUNTER
+                ).execute()
+
+        query = Report.update(**updates).where(Report.id == id)
+        if db.returning_clause:
+            report = next(iter(query.returning(Report).objects()), None)
+        elif query.execute():
+            report = Report.get_or_none(Report.id == id)
+        else:
+            report = None
+        if report is None:
+            transaction.rollback()
+            return None
+
+        if isinstance(updates.get('datetime'), datetime.datetime):
+            Counter.update(datetime=updates['datetime']).where(
+                (Counter.name == LAST_REPORT_COUNTER) &
+                ((Counter.datetime == None) |
+                 (Counter.datetime < updates['datetime']))
+            ).execute()
+        return report
+
+
+def create_reports(reports, batch_size=CREATE_BATCH_SIZE):
+    """
+    Insert new reports by batches, each batch in its own short transaction,
+    with a single bump of the data version and update of the stats per
+    batch. Meant for bulk imports, which should not hold the write lock for
+    long.
+
+    :param reports: A list of new ``Report`` objects, not saved yet.
+    :param batch_size: Maximum number of reports inserted per transaction.
+    :return: The number of inserted reports.
+    """
+    fields = [
+        field for field in Report._meta.sorted_fields
+        if field is not Report.id
+    ]
+    for i in range(0, len(reports), batch_size):
+        batch = reports[i:i + batch_size]
+        for report in batch:
+            report._update_index_keys()
+        with db.atomic():
+            change_seq = bump_data_version()
+            for report in batch:
+                report.change_seq = change_seq
+            update_stats(batch, True)
+            Report.insert_many(
+                [
+                    [getattr(report, field.name) for field in fields]
+                    for report in batch
+                ],
+                fields
+            ).execute()
+    return len(reports)
+
+
+class ArchivedReport(Report):
+    """
+    An inactive report, moved out of the reports table by
+    ``archive_reports``
+    """
+    archived_datetime = peewee.DateTimeField(
+        default=UTC_now
+    )
+
+    class Meta:
+        table_name = 'archived_report'
+        indexes = (
+            # Filtering of the archived reports by type, through the API
+            (('type',), False),
+        )
+
+    def save(self, *args, **kwargs):
+        # Archived reports are not counted as reports
+        return BaseModel.save(self, *args, **kwargs)
+
+
+def archive_reports(now=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move the inactive reports (expired or downvoted) to the archived reports
+    table, by batches. Each batch is moved in its own transaction.
+
+    Archived reports keep their id. Their change sequence is set to the data
+    version of the archival, so that clients synchronizing with a
+    ``since`` cursor get them as deleted.
+
+    :param now: Optional naive UTC datetime to check the expiration of the
+        reports against.
+    :param batch_size: Maximum number of reports moved per transaction.
+    :return: The number of archived reports.
+    """
+    if now is None:
+        now = UTC_now()
+    is_inactive = (
+        (Report.expiration_datetime <= now) |
+        (Report.downvotes >= REPORT_DOWNVOTES_THRESHOLD)
+    )
+    fields = [
+        field for field in Report._meta.sorted_fields
+        if field.name != 'change_seq'
+    ]
+    nb_archived = 0
+    while True:
+        with db.atomic():
+            # Expired reports have to be swept before being archived, so
+            # that the number of active reports stays right
+            sweep_expired_reports(now)
+            ids = [
+                id for (id,) in Report.select(Report.id).where(
+                    is_inactive
+                ).order_by(Report.id).limit(batch_size).tuples()
+            ]
+            if not ids:
+                break
+
+            last_sweep = Counter.get(
+                Counter.name == NB_ACTIVE_REPORTS_COUNTER
+            ).datetime
+            nb_active = Report.select().where(
+                (Report.id << ids) &
+                ((Report.expiration_datetime == None) |
+                 (Report.expiration_datetime > last_sweep))
+            ).count()
+            change_seq = bump_data_version()
+            ArchivedReport.insert_from(
+                Report.select(
+                    *(fields + [peewee.Value(change_seq), peewee.Value(now)])
+                ).where(Report.id << ids),
+                [getattr(ArchivedReport, field.name) for field in fields] + [
+                    ArchivedReport.change_seq,
+                    ArchivedReport.archived_datetime
+                ]
+            ).execute()
+            Report.delete().where(Report.id << ids).execute()
+
+            Counter.update(value=Counter.value - nb_active).where(
+                Counter.name == NB_ACTIVE_REPORTS_COUNTER
+            ).execute()
+            Counter.update(value=Counter.value + len(ids)).where(
+                Counter.name == NB_ARCHIVED_REPORTS_COUNTER
+            ).execute()
+        nb_archived += len(ids)
+    return nb_archived
+
+
+# Fields of Report which are not exposed through the API
+REPORT_INTERNAL_FIELDS = [
+    Report.grid_cell, Report.shape_extent, Report.change_seq
+]
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Pre-forking, multi-threaded WSGI server, built on ``wsgiref``.
+
+A master process binds the listening socket and forks the worker processes,
+which all accept connections on it. Each worker serves requests with a
+bounded pool of threads, keeping connections alive between requests. Workers
+which die are started again.
+
+The master process handles the following signals:
+
+* ``SIGHUP`` starts new workers and gracefully stops the previous ones, for
+  instance to reopen the database connections. The code is not reloaded,
+  restart the server for that.
+* ``SIGTERM`` and ``SIGINT`` gracefully stop the workers, and the server.
+
+Workers gracefully stop by no longer accepting connections and letting the
+requests in progress finish, for at most ``GRACEFUL_TIMEOUT`` seconds.
+"""
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import wsgiref.simple_server
+
+from server import KEEPALIVE_TIMEOUT
+
+# Maximum time to let the requests in progress finish when stopping a worker,
+# in seconds
+GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', '30'))
+# Request bodies not read by the application are skipped if smaller than this
+# number of bytes, otherwise the connection is closed
+MAX_SKIPPED_BODY_SIZE = 64 * 1024
+
+
+class RequestBody(object):
+    """
+    The body of a request, as the ``wsgi.input`` stream, preventing the
+    application from reading past its end on kept-alive connections.
+    """
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class KeepAliveServerHandler(wsgiref.simple_server.ServerHandler):
+    """
+    Run the WSGI application on a request, writing an HTTP/1.1 response.
+
+    Responses without a ``Content-Length`` are sent with the chunked transfer
+    encoding to HTTP/1.1 clients, so that the connection can be kept alive.
+    """
+    http_version = '1.1'
+    chunked = False
+
+    def cleanup_headers(self):
+        super(KeepAliveServerHandler, self).cleanup_headers()
+        request_handler = self.request_handler
+        if 'Content-Length' not in self.headers:
+            if (
+                self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1' and
+                self.environ['REQUEST_METHOD'] != 'HEAD'
+            ):
+                self.chunked = True
+                self.headers['Transfer-Encoding'] = 'chunked'
+            else:
+                request_handler.close_connection = True
+        if request_handler.server.stopping:
+            request_handler.close_connection = True
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+    def handle_error(self):
+        # The response might be truncated
+        self.request_handler.close_connection = True
+        super(KeepAliveServerHandler, self).handle_error()
+
+    def write(self, data):
+        if not self.status:
+            raise AssertionError("write() before start_response()")
+        if not self.headers_sent:
+            # Whether the response is chunked is decided with the headers
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+        if not self.chunked:
+            self._write(data)
+        elif data:
+            # An empty chunk would end the response
+            self._write(b'%x\r\n%s\r\n' % (len(data), data))
+        self._flush()
+
+    def finish_content(self):
+        super(KeepAliveServerHandler, self).finish_content()
+        if self.chunked:
+            self._write(b'0\r\n\r\n')
+            self._flush()
+
+
+class KeepAliveRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    Serve the requests of a connection, keeping it alive between requests.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Timeout of the reads and writes on the connection, in seconds
+    timeout = KEEPALIVE_TIMEOUT
+
+    def handle(self):
+        self.close_connection = False
+        while not self.close_connection and not self.server.stopping:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        self.server.set_idle(self.connection, True)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except OSError:
+            # Timed out or closed
+            self.raw_requestline = b''
+        finally:
+            self.server.set_idle(self.connection, False)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            # An error was sent
+            self.close_connection = True
+            return
+
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            try:
+                body = RequestBody(self.rfile, max(int(length), 0))
+            except ValueError:
+                self.send_error(400)
+                self.close_connection = True
+                return
+        else:
+            # Unknown length, for instance a chunked body read by the
+            # application itself
+            body = self.rfile
+            if self.headers.get('Transfer-Encoding'):
+                self.close_connection = True
+            else:
+                body = RequestBody(self.rfile, 0)
+
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=self.server.threads > 1, multiprocess=True
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+        if isinstance(body, RequestBody) and body.remaining:
+            if body.remaining > MAX_SKIPPED_BODY_SIZE:
+                self.close_connection = True
+            else:
+                body.read()
+
+
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+    """
+    A WSGI server on an already bound socket, handling requests with a
+    bounded number of threads.
+
+    When all the threads are busy, no more connections are accepted, letting
+    other workers accept them.
+    """
+    def __init__(self, sock, app, threads):
+        """
+        :param sock: The listening socket, in non-blocking mode as it is
+            shared between workers.
+        :param app: The WSGI application.
+        :param threads: Maximum number of connections handled at once.
+        """
+        wsgiref.simple_server.WSGIServer.__init__(
+            self, sock.getsockname()[:2], KeepAliveRequestHandler,
+            bind_and_activate=False
+        )
+        self.socket.close()
+        self.socket = sock
+        self.server_name, self.server_port = sock.getsockname()[:2]
+        self.setup_environ()
+        self.set_app(app)
+        self.stopping = False
+        self.threads = threads
+        self._slots = threading.Semaphore(threads)
+        self._threads = set()
+        self._idle_connections = set()
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        thread = threading.Thread(
+            target=self._process_request_thread,
+            args=(request, client_address),
+            daemon=True
+        )
+        with self._lock:
+            self._threads.add(thread)
+        thread.start()
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                self._threads.discard(threading.current_thread())
+            self._slots.release()
+
+    def set_idle(self, connection, idle):
+        """
+        Mark a connection as waiting for a request, or not.
+        """
+        with self._lock:
+            if self.stopping and idle:
+                # Do not wait for another request
+                connection.shutdown(socket.SHUT_RD)
+            elif idle:
+                self._idle_connections.add(connection)
+            else:
+                self._idle_connections.discard(connection)
+
+    def server_close(self):
+        # The listening socket belongs to the master process
+        pass
+
+    def stop(self, timeout=GRACEFUL_TIMEOUT):
+        """
+        Stop accepting connections and wait for the requests in progress to
+        finish. Must not be called from the thread running ``serve_forever``.
+
+        :param timeout: Maximum time to wait for, in seconds.
+        :return: Whether all the requests finished in time.
+        """
+        self.shutdown()
+        with self._lock:
+            self.stopping = True
+            for connection in self._idle_connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+            threads = list(self._threads)
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        return not any(thread.is_alive() for thread in threads)
+
+
+def _run_worker(app, sock, index, threads, on_worker_start, on_worker_stop):
+    """
+    Serve requests in a worker process, until it receives ``SIGTERM`` or
+    ``SIGINT``.
+    """
+    stop = threading.Event()
+
+    def handle_stop(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    if on_worker_start is not None:
+        on_worker_start(index)
+    server = ThreadPoolWSGIServer(sock, app, threads)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while not stop.wait(1) and thread.is_alive():
+        pass
+    if not server.stop():
+        logging.warning(
+            'Worker %d: requests still in progress after %ds, exiting.',
+            os.getpid(), GRACEFUL_TIMEOUT
+        )
+    if on_worker_stop is not None:
+        on_worker_stop(index)
+
+
+def serve(app, host='127.0.0.1', port=8081, workers=1, threads=1,
+          on_worker_start=None, on_worker_stop=None):
+    """
+    Serve a WSGI application with pre-forked worker processes, until
+    ``SIGTERM`` or ``SIGINT`` is received.
+
+    :param app: The WSGI application.
+    :param host: Host to listen to.
+    :param port: Port to listen on.
+    :param workers: Number of worker processes.
+    :param threads: Maximum number of connections handled at once by each
+        worker.
+    :param on_worker_start: Optional function called in each worker process
+        when it starts, with the index of the worker (from ``0`` to
+        ``workers - 1``), for instance to open connections.
+    :param on_worker_stop: Optional function called in each worker process
+        when it gracefully stops, with the index of the worker.
+    """
+    sock = socket.create_server((host, port), backlog=1024)
+    # Workers compete for the connections
+    sock.setblocking(False)
+
+    signals = []
+
+    def handle_signal(signum, frame):
+        signals.append(signum)
+
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handle_signal)
+
+    running = {}  # Index of the running workers, by pid
+    retiring = set()
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                _run_worker(
+                    app, sock, index, threads,
+                    on_worker_start, on_worker_stop
+                )
+            except BaseException:
+                logging.exception('Worker %d crashed.', os.getpid())
+                status = 1
+            finally:
+                # Never get back to the code of the master process
+                os._exit(status)
+        running[pid] = index
+        return pid
+
+    logging.info(
+        'Serving on http://%s:%d/ with %d workers of %d threads.',
+        host, port, workers, threads
+    )
+    for index in range(workers):
+        spawn(index)
+
+    stopping_since = None
+    while running or retiring:
+        # Reap the stopped workers
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if not pid:
+                break
+            retiring.discard(pid)
+            index = running.pop(pid, None)
+            if index is not None and stopping_since is None:
+                logging.warning('Worker %d died, restarting it.', pid)
+                time.sleep(1)
+                spawn(index)
+
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and stopping_since is None:
+                logging.info('Restarting the workers.')
+                previous = list(running.items())
+                for _, index in previous:
+                    spawn(index)
+                for pid, _ in previous:
+                    del running[pid]
+                    retiring.add(pid)
+                    os.kill(pid, signal.SIGTERM)
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                if stopping_since is None:
+                    logging.info('Stopping the workers.')
+                    stopping_since = time.time()
+                    for pid in list(running):
+                        os.kill(pid, signal.SIGTERM)
+
+        if (
+            stopping_since is not None and
+            time.time() - stopping_since > GRACEFUL_TIMEOUT + 5
+        ):
+            for pid in list(running) + list(retiring):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        time.sleep(0.2)
+    sock.close()
@@ -6,12 +6,29 @@ Routes definitions
 import arrow
 import json
 import os
+import time
+from urllib.parse import urlencode
 
 import bottle
+import peewee
 
-from server.models import Report
+from server.models import (ArchivedReport, db, get_data_version,
+                           get_reports_stats, Report,
+                           REPORT_DOWNVOTES_THRESHOLD, stream_with_db,
+                           update_report)
 from server.tools import UTC_now
-from server import jsonapi
+from server import cache, changes, geo, jsonapi, serializers, votes
+
+# Map tiles are only served from this zoom level, as lower zoom levels would
+# contain too many reports
+TILES_MIN_ZOOM = int(os.environ.get('TILES_MIN_ZOOM', '8'))
+# Streams of changes poll the database every this number of seconds, to
+# notice the writes of other processes, and are closed after
+# STREAM_MAX_DURATION seconds
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', '5'))
+STREAM_MAX_DURATION = float(os.environ.get('STREAM_MAX_DURATION', '300'))
+# Maximum number of operations in a single batch request
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', '100'))
 
 
 class AuthenticationError(Exception):
@@ -71,6 +88,13 @@ def get_all_reports():
         Filtering can be done through the ``filter`` GET param, according
         to JSON API spec (http://jsonapi.org/recommendations/#filtering).
 
+    .. note::
+
+        Reports can be restricted to a geographical area using
+        ``filter[bbox]=minLng,minLat,maxLng,maxLat`` or
+        ``filter[near]=lat,lng&filter[radius]=meters``. When ``filter[near]``
+        is used, ``sort=distance`` returns the nearest reports first.
+
     .. note::
 
         By default no pagination is done. Pagination can be forced using
@@ -78,10 +102,59 @@ def get_all_reports():
         ``page[number]`` to specify which page to return. Pages are numbered
         starting from 0.
 
+    .. note::
+
+        Instead of ``page[number]``, the ``links.next`` and ``links.prev``
+        URLs of a page can be followed. They use ``page[after]`` and
+        ``page[before]`` cursors, fetching a page at constant cost.
+
     .. note::
 
         Sorting can be handled through the ``sort`` GET param, according to
         JSON API spec (http://jsonapi.org/format/#fetching-sorting).
+        Paginated reports are sorted by id by default, others are not
+        sorted.
+
+    .. note::
+
+        Only some fields can be requested through the ``fields[reports]``
+        GET param, according to JSON API spec
+        (http://jsonapi.org/format/#fetching-sparse-fieldsets).
+
+    .. note::
+
+        Passing ``format=geojson`` returns a GeoJSON ``FeatureCollection``
+        and ``format=columnar`` a compact output, with the values of each
+        attribute as parallel arrays, quantized coordinates and UNIX
+        timestamps.
+
+    .. note::
+
+        Passing ``archived=true`` returns the archived reports (expired or
+        downvoted reports moved out of the reports table) instead.
+
+    .. note::
+
+        Passing ``aggregate=grid&zoom=N`` returns clusters of reports instead,
+        with their number per type, for a map displayed at zoom level ``N``.
+        Only filters apply to clusters.
+
+    .. note::
+
+        Passing a ``since`` cursor (``0`` for an initial synchronization)
+        returns only the active reports changed since this cursor. The ids
+        of the reports which became inactive are listed in ``meta.deleted``
+        and the cursor for the next synchronization in ``meta.cursor``.
+
+    .. note::
+
+        Responses are cached until the next write to the reports. Filters on
+        datetime fields are rounded down to the minute (see
+        ``CACHE_TIME_BUCKET``) so that polling clients share cache entries.
+        ``ETag`` and ``Last-Modified`` headers are sent and conditional
+        requests are answered with a ``304 Not Modified`` when the data did
+        not change. Other responses are streamed, compressed according to
+        the ``Accept-Encoding`` header.
 
     :return: The available reports objects in a JSON ``data`` dict.
     """
@@ -89,42 +162,596 @@ def get_all_reports():
     if bottle.request.method == 'OPTIONS':
         return {}
 
-    # Handle filtering, pagination and sorting
-    try:
-        filters, page_number, page_size, sorting = jsonapi.JsonApiParseQuery(
-            bottle.request.query,
-            Report,
-            default_sorting='id'
+    # Handle delta synchronization
+    if 'since' in bottle.request.query:
+        try:
+            return _get_changed_reports(bottle.request.query)
+        except ValueError as exc:
+            return jsonapi.JsonApiError(
+                400, "Invalid parameters: " + str(exc)
+            )
+
+    query_params = cache.normalize_query(bottle.request.query, Report)
+    return _cached_response(
+        cache.query_key(bottle.request.path, query_params),
+        lambda: _get_all_reports(query_params, bottle.request.path)
+    )
+
+
+def _cached_response(cache_key, get_chunks, now=None,
+                     cache_control='no-cache'):
+    """
+    Answer conditional requests and serve a response from cache if the data
+    did not change. Otherwise, stream the response, caching it on the fly.
+
+    :param cache_key: Key of the response, see ``cache.query_key``.
+    :param get_chunks: A function returning a generator of the chunks of the
+        JSON response. It can raise a ``ValueError`` for invalid parameters.
+    :param now: Optional naive UTC datetime the response is computed at, if
+        it depends on the current datetime.
+    :param cache_control: Value of the ``Cache-Control`` header.
+    :return: The response body.
+    """
+    data_version, last_modified = get_data_version()
+    if now is not None and last_modified is not None:
+        last_modified = max(last_modified, now)
+    encoding = cache.negotiate_encoding(
+        bottle.request.headers.get('Accept-Encoding')
+    )
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+    etag = cache.make_etag(cache_key, data_version, encoding)
+    if cache.is_not_modified(etag, last_modified):
+        return cache.not_modified(etag, last_modified, cache_control)
+
+    body = cache.responses_cache.get(cache_key, data_version, encoding)
+    if body is None:
+        try:
+            chunks = get_chunks()
+        except ValueError as exc:
+            return jsonapi.JsonApiError(
+                400, "Invalid parameters: " + str(exc)
+            )
+        body = cache.responses_cache.set_from_stream(
+            cache_key, data_version, stream_with_db(chunks), encoding
         )
-    except ValueError as exc:
-        return jsonapi.JsonApiError(400, "Invalid parameters: " + str(exc))
+
+    cache.set_validators(etag, last_modified, cache_control)
+    bottle.response.content_type = "application/json"
+    if encoding is not None:
+        bottle.response.set_header('Content-Encoding', encoding)
+    return body
+
+
+def _get_all_reports(query_params, path):
+    """
+    Query the reports and serialize the response of ``get_all_reports``.
+
+    :param query_params: A Bottle query dict.
+    :param path: Path of the requested route, for pagination links.
+    :return: A generator of the chunks of the JSON response.
+    """
+    # Handle archived reports
+    archived = query_params.get('archived', 'false')
+    if archived not in ['true', 'false']:
+        raise ValueError("Invalid archived parameter provided.")
+    model = ArchivedReport if archived == 'true' else Report
+
+    # Handle aggregation
+    if 'aggregate' in query_params:
+        return _get_aggregated_reports(query_params, model)
+
+    # Handle filtering, pagination and sorting. Unless paginating, reports
+    # are not sorted by default, which lets the database read them from the
+    # indexes matching the filters.
+    filters, page_number, page_size, sorting = jsonapi.JsonApiParseQuery(
+        query_params,
+        model,
+        default_sorting='id' if 'page[size]' in query_params else None
+    )
+    cursor_filters, sorting, cursor_keys, reverse = (
+        jsonapi.JsonApiParsePageCursor(query_params, model, sorting)
+    )
+    fields = jsonapi.JsonApiParseFields(
+        query_params, 'reports', serializers.REPORT_FIELDS
+    )
 
     # Query
-    query = Report.select()
-    if filters:
-        query = query.where(*filters)
+    query = model.select()
+    if filters or cursor_filters:
+        query = query.where(*(filters + cursor_filters))
     query = query.order_by(*sorting)
-    if page_number is not None and page_size is not None:
+    if cursor_filters:
+        if page_size is not None:
+            query = query.limit(page_size)
+    elif page_number is not None and page_size is not None:
         query = query.paginate(page_number, page_size)
 
+    pagination = None
     if (
-        'format' in bottle.request.query and
-        bottle.request.query['format'] == 'geojson'
+        cursor_keys is not None and page_size is not None and
+        'page[number]' not in query_params
     ):
-        return {
-            "type": "FeatureCollection",
-            "features": [
-                r.to_geojson_feature()
-                for r in query
-            ]
+        pagination = (path, query_params, page_size, cursor_keys)
+
+    return _stream_reports(
+        query, query_params.get('format'), fields, reverse, pagination
+    )
+
+
+def _get_aggregated_reports(query_params, model=Report):
+    """
+    Query the reports and serialize the response of ``get_all_reports``, for
+    an aggregation of the reports in clusters.
+
+    :param query_params: A Bottle query dict with ``aggregate`` and ``zoom``
+        params.
+    :param model: Model of the reports to aggregate, ``Report`` or
+        ``ArchivedReport``.
+    :return: A generator of the chunks of the JSON response.
+    """
+    if query_params['aggregate'] != 'grid':
+        raise ValueError("Invalid aggregation provided.")
+    try:
+        zoom = int(query_params.get('zoom', ''))
+        assert 0 <= zoom <= geo.TILES_MAX_ZOOM
+    except (AssertionError, ValueError):
+        raise ValueError("Invalid zoom level provided.")
+
+    # Only filters are relevant, clusters are ordered by position
+    filters, _, _, _ = jsonapi.JsonApiParseQuery(query_params, model)
+
+    # Reports are first counted per cell of the spatial grid in the database,
+    # which only returns a few rows per square kilometer
+    query = model.select(
+        model.type,
+        peewee.fn.COUNT(model.id),
+        peewee.fn.SUM(model.lat),
+        peewee.fn.SUM(model.lng)
+    )
+    if filters:
+        query = query.where(*filters)
+    query = query.group_by(model.grid_cell, model.type)
+    return _stream_clusters(query, zoom, query_params.get('format'))
+
+
+def _stream_clusters(query, zoom, output_format=None):
+    """
+    Merge counts of reports per cell of the spatial grid into clusters, and
+    serialize them.
+
+    The query is only executed once the stream is consumed.
+
+    :param query: A query on reports, returning the type, the number, the
+        sum of the latitudes and the sum of the longitudes of the reports.
+    :param zoom: Zoom level to compute the clusters for.
+    :param output_format: Optional output format, ``geojson``.
+    :return: A generator of the chunks of the JSON response.
+    """
+    clusters = {}
+    for report_type, count, lat_sum, lng_sum in query.tuples():
+        cell = geo.cluster_cell(lat_sum / count, lng_sum / count, zoom)
+        cluster = clusters.setdefault(
+            cell, {'count': 0, 'lat': 0.0, 'lng': 0.0, 'types': {}}
+        )
+        cluster['count'] += count
+        cluster['lat'] += lat_sum
+        cluster['lng'] += lng_sum
+        cluster['types'][report_type] = (
+            cluster['types'].get(report_type, 0) + count
+        )
+
+    items = []
+    for (row, column), cluster in sorted(clusters.items()):
+        # Clusters are located at the mean position of their reports
+        lat = cluster['lat'] / cluster['count']
+        lng = cluster['lng'] / cluster['count']
+        id = '{}/{}/{}'.format(zoom, row, column)
+        if output_format == 'geojson':
+            items.append({
+                "type": "Feature",
+                "properties": {
+                    "type": "clusters",
+                    "id": id,
+                    "count": cluster['count'],
+                    "types": cluster['types']
+                },
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [lng, lat]
+                }
+            })
+        else:
+            items.append({
+                "type": "clusters",
+                "id": id,
+                "attributes": {
+                    "lat": lat,
+                    "lng": lng,
+                    "count": cluster['count'],
+                    "types": cluster['types']
+                }
+            })
+
+    if output_format == 'geojson':
+        head, tail = '{"type": "FeatureCollection", "features": [', ']}'
+    else:
+        head, tail = '{"data": [', ']}'
+    for chunk in jsonapi.JsonApiStreamList(head, items, tail):
+        yield chunk
+
+
+def _page_link(path, query_params, param, cursor_values):
+    """
+    Build a link to another page of results.
+
+    :param path: Path of the requested route.
+    :param query_params: A Bottle query dict.
+    :param param: Pagination parameter, ``page[after]`` or ``page[before]``.
+    :param cursor_values: Values of the sorting keys of the report to use as
+        cursor.
+    :return: The URL of the page.
+    """
+    cursor = jsonapi.JsonApiEncodePageCursor(cursor_values)
+    params = [
+        (k, v) for k, v in query_params.allitems()
+        if k not in ['page[after]', 'page[before]', 'page[number]']
+    ]
+    params.append((param, cursor))
+    return path + '?' + urlencode(params)
+
+
+def _page_links(pagination, first, last, count):
+    """
+    Build the pagination links of a page of reports.
+
+    :param pagination: Tuple of the path of the requested route, the query
+        dict, the page size and the sorting keys.
+    :param first: Values of the sorting keys of the first report of the
+        page.
+    :param last: Values of the sorting keys of the last report of the page.
+    :param count: Number of reports in the page.
+    :return: A dict of the ``next`` and ``prev`` links, if any.
+    """
+    path, query_params, page_size, _ = pagination
+    links = {}
+    if count >= page_size:
+        links['next'] = _page_link(path, query_params, 'page[after]', last)
+    if (
+        count and
+        ('page[after]' in query_params or 'page[before]' in query_params)
+    ):
+        links['prev'] = _page_link(path, query_params, 'page[before]', first)
+    return links
+
+
+def _stream_reports(query, output_format=None, fields=None, reverse=False,
+                    pagination=None):
+    """
+    Serialize reports incrementally.
+
+    The query is only executed once the stream is consumed.
+
+    :param query: A query on reports.
+    :param output_format: Optional output format, ``geojson`` or
+        ``columnar``.
+    :param fields: Optional list of fields to output, defaults to all.
+    :param reverse: Whether to output the reports in reverse order.
+    :param pagination: Optional tuple of the path of the requested route, the
+        query dict, the page size and the sorting keys, to output pagination
+        links (except with the GeoJSON output format).
+    :return: A generator of the chunks of the JSON response.
+    """
+    keys = None
+    if pagination is not None:
+        keys = [field for field, _ in pagination[3]]
+
+    if output_format == 'geojson':
+        items = serializers.reports_to_geojson_features(query, fields)
+        if reverse:
+            items = reversed(list(items))
+        chunks = jsonapi.JsonApiStreamList(
+            '{"type": "FeatureCollection", "features": [',
+            items,
+            ']}',
+            encoded=True
+        )
+    elif output_format == 'columnar':
+        # Columns can only be output once all the reports are read
+        columns = serializers.reports_to_columns(
+            query, fields, keys=keys, reverse=reverse
+        )
+        key_values = None
+        if keys is not None:
+            columns, key_values = columns
+        ids = columns.pop('id')
+        response = {
+            "data": {
+                "type": "reports",
+                "id": ids,
+                "attributes": columns
+            },
+            "meta": {
+                "count": len(ids),
+                "coordinates_scale": serializers.COLUMNAR_COORDINATES_SCALE
+            }
         }
+        if key_values is not None:
+            response["links"] = _page_links(
+                pagination,
+                key_values[0] if key_values else None,
+                key_values[-1] if key_values else None,
+                len(ids)
+            )
+        chunks = [json.dumps(response)]
     else:
-        return {
-            "data": [
-                r.to_json()
-                for r in query
-            ]
+        items = serializers.reports_to_json(query, fields, keys=keys)
+        if reverse:
+            items = reversed(list(items))
+
+        tail = ']}'
+        if pagination is not None:
+            page = {'first': None, 'last': None, 'count': 0}
+
+            def track_page(items):
+                for item, cursor_values in items:
+                    if page['first'] is None:
+                        page['first'] = cursor_values
+                    page['last'] = cursor_values
+                    page['count'] += 1
+                    yield item
+
+            def tail_with_links():
+                links = _page_links(
+                    pagination, page['first'], page['last'], page['count']
+                )
+                return '], "links": ' + json.dumps(links) + '}'
+
+            items = track_page(items)
+            tail = tail_with_links
+
+        chunks = jsonapi.JsonApiStreamList('{"data": [', items, tail)
+    for chunk in chunks:
+        yield chunk
+
+
+def _get_changed_reports(query_params):
+    """
+    Build the response of ``get_all_reports`` for a delta synchronization,
+    that is the active reports changed since a cursor and the ids of the
+    reports which became inactive.
+
+    :param query_params: A Bottle query dict with a ``since`` cursor.
+    :return: The response, as a JSON-serializable dict.
+    """
+    since_seq, since = _parse_since_cursor(query_params['since'])
+
+    # Only filters and sparse fieldsets are relevant, changes are ordered by
+    # data version
+    fields = jsonapi.JsonApiParseFields(
+        query_params, 'reports', serializers.REPORT_FIELDS
+    )
+    query, deleted, cursor = _get_changes(query_params, since_seq, since)
+
+    return {
+        "data": list(serializers.reports_to_json(query, fields)),
+        "meta": {
+            "deleted": deleted,
+            "cursor": cursor
         }
+    }
+
+
+def _parse_since_cursor(value):
+    """
+    Parse a delta synchronization cursor.
+
+    A cursor is made of a data version and a timestamp. The initial cursor is
+    "0".
+
+    :param value: The cursor, as a string.
+    :return: A tuple of the data version and the datetime of the cursor
+        (``None`` for the initial cursor).
+    """
+    try:
+        cursor = [int(x) for x in value.split('-')]
+        if len(cursor) == 1 and cursor[0] == 0:
+            return 0, None
+        since_seq, since_timestamp = cursor
+        return since_seq, arrow.get(since_timestamp).naive
+    except ValueError:
+        raise ValueError("Invalid since cursor provided.")
+
+
+def _get_changes(query_params, since_seq, since):
+    """
+    Get the changes to the reports since a delta synchronization cursor.
+
+    :param query_params: A Bottle query dict, with the filters to apply.
+    :param since_seq: Data version of the cursor.
+    :param since: Datetime of the cursor, ``None`` for the initial cursor.
+    :return: A tuple of a query of the active reports changed since the
+        cursor (ordered by data version), the list of ids of the reports which
+        became inactive since the cursor and the next cursor.
+    """
+    filters, _, _, _ = jsonapi.JsonApiParseQuery(query_params, Report)
+
+    # Read the data version first, so that concurrent changes are sent again
+    # on next synchronization
+    data_version, _ = get_data_version()
+    now_timestamp = int(time.time())
+    now = arrow.get(now_timestamp).naive
+
+    is_active = (
+        (
+            (Report.expiration_datetime == None) |
+            (Report.expiration_datetime > now)
+        ) &
+        (Report.downvotes < REPORT_DOWNVOTES_THRESHOLD)
+    )
+    is_changed = (Report.change_seq > since_seq)
+
+    query = Report.select().where(is_changed & is_active, *filters)
+    query = query.order_by(Report.change_seq)
+
+    deleted = []
+    if since is not None:
+        is_expired = (
+            (Report.expiration_datetime > since) &
+            (Report.expiration_datetime <= now)
+        )
+        deleted_query = Report.select(Report.id).where(
+            (is_changed & ~is_active) | is_expired,
+            *filters
+        )
+        deleted = [id for (id,) in deleted_query.tuples()]
+
+        # Reports archived since the cursor
+        archived_filters, _, _, _ = jsonapi.JsonApiParseQuery(
+            query_params, ArchivedReport
+        )
+        archived_query = ArchivedReport.select(ArchivedReport.id).where(
+            ArchivedReport.change_seq > since_seq,
+            *archived_filters
+        )
+        deleted.extend(id for (id,) in archived_query.tuples())
+
+    return query, deleted, "{}-{}".format(data_version, now_timestamp)
+
+
+@bottle.route('/api/v1/reports/stream', ["GET", "OPTIONS"])
+def get_reports_stream():
+    """
+    API v1 GET reports stream route. Stream the changes to the reports, as
+    Server-Sent Events.
+
+    Example::
+
+        > GET /api/v1/reports/stream?filter[bbox]=2.25,48.81,2.42,48.90
+
+        event: created
+        data: {"type": "reports", "id": 1162, "attributes": {…}}
+
+        event: voted
+        data: {"type": "reports", "id": 1161, "attributes": {…}}
+
+        event: expired
+        data: {"id": 1042}
+
+        id: 4242-1539783755
+
+    .. note::
+
+        Reports are created, voted for, or expired (which includes reports
+        downvoted or archived). Filters and sparse fieldsets apply as for
+        the reports listing.
+
+    .. note::
+
+        Each batch of events ends with an event id, which is a delta
+        synchronization cursor. Only the changes after the ``since`` GET
+        param cursor (or the ``Last-Event-ID`` header sent by reconnecting
+        clients) are streamed. Without cursor, only the changes after the
+        start of the stream are.
+
+    .. note::
+
+        Changes made by this server process are sent immediately, others
+        within ``STREAM_POLL_INTERVAL`` seconds. Streams are closed after
+        ``STREAM_MAX_DURATION`` seconds, clients are expected to reconnect.
+
+    .. note::
+
+        Streams are refused with a 503 error by single-threaded servers,
+        which they would block.
+
+    :return: A stream of events, as ``text/event-stream``.
+    """
+    # Handle CORS
+    if bottle.request.method == 'OPTIONS':
+        return {}
+
+    if not bottle.request.environ.get('wsgi.multithread'):
+        # The stream would hold the only thread of the server
+        return jsonapi.JsonApiError(
+            503, "Streams require a multithreaded server."
+        )
+
+    query_params = bottle.request.query
+    cursor = bottle.request.headers.get(
+        'Last-Event-ID', query_params.get('since')
+    )
+    try:
+        # Parse the parameters upfront, to report errors
+        jsonapi.JsonApiParseQuery(query_params, Report)
+        fields = jsonapi.JsonApiParseFields(
+            query_params, 'reports', serializers.REPORT_FIELDS
+        )
+        if cursor is None:
+            since_seq, since = get_data_version()[0], UTC_now()
+        else:
+            since_seq, since = _parse_since_cursor(cursor)
+    except ValueError as exc:
+        return jsonapi.JsonApiError(400, "Invalid parameters: " + str(exc))
+
+    bottle.response.content_type = 'text/event-stream'
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    # Do not let reverse proxies buffer the events
+    bottle.response.set_header('X-Accel-Buffering', 'no')
+    return _stream_changes(query_params, fields, since_seq, since)
+
+
+def _stream_changes(query_params, fields, since_seq, since):
+    """
+    Stream the changes to the reports as Server-Sent Events, see
+    ``get_reports_stream``.
+
+    :param query_params: A Bottle query dict, with the filters to apply.
+    :param fields: Fields to output, see ``jsonapi.JsonApiParseFields``.
+    :param since_seq: Data version to stream the changes from.
+    :param since: Datetime to stream the changes from, ``None`` to start with
+        all the active reports.
+    :returns: A generator of events, as UTF-8 encoded bytes.
+    """
+    encoder = jsonapi.DateAwareJSONEncoder()
+    end = time.time() + STREAM_MAX_DURATION
+    generation = changes.notifier.generation
+    while True:
+        # Only hold a database connection while polling, as streams are long
+        # lived
+        db.connect(reuse_if_open=True)
+        try:
+            query, deleted, cursor = _get_changes(
+                query_params, since_seq, since
+            )
+            reports = list(serializers.reports_to_json(
+                query, fields, keys=[Report.upvotes, Report.downvotes]
+            ))
+        finally:
+            if not db.is_closed():
+                db.close()
+
+        events = []
+        for report, (upvotes, downvotes) in reports:
+            # Only creations leave the votes untouched
+            event = 'created' if upvotes == 0 and downvotes == 0 else 'voted'
+            events.append('event: {}\ndata: {}\n\n'.format(
+                event, encoder.encode(report)
+            ))
+        for id in deleted:
+            events.append('event: expired\ndata: {}\n\n'.format(
+                encoder.encode({'id': id})
+            ))
+        # An event without data only updates the id clients reconnect with,
+        # and keeps the connection alive
+        events.append('id: {}\n\n'.format(cursor))
+        yield ''.join(events).encode('utf-8')
+
+        if time.time() >= end:
+            return
+        since_seq, since = _parse_since_cursor(cursor)
+        generation = changes.notifier.wait(
+            generation, min(STREAM_POLL_INTERVAL, end - time.time())
+        )
 
 
 @bottle.route('/api/v1/reports', ["POST", "OPTIONS"])
@@ -178,27 +805,56 @@ def post_report():
         return jsonapi.JsonApiError(400, "Invalid JSON payload: " + str(exc))
 
     try:
-        r = Report(
-            type=payload['type'],
-            lat=payload['lat'],
-            lng=payload['lng'],
-            source=payload.get('source', 'unknown'),
-            shape_geojson=payload.get('shape_geojson', None)
-        )
-        # Handle expiration
-        if r.type in ['accident', 'gcum']:
-            r.expiration_datetime = (
-                arrow.get(UTC_now()).shift(hours=+1).naive
-            )
-        r.save()
-    except KeyError as exc:
+        r = _build_report(payload)
+    except (KeyError, ValueError) as exc:
         return jsonapi.JsonApiError(400, "Invalid report payload: " + str(exc))
+    r.save()
+    changes.notifier.notify()
 
     return {
         "data": r.to_json()
     }
 
 
+def _build_report(payload):
+    """
+    Build a new report from a POST payload, validating it.
+
+    :param payload: The decoded JSON payload.
+    :return: An unsaved ``Report``.
+    :raises KeyError: If a required field is missing.
+    :raises ValueError: If the payload is invalid.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("Expected a JSON object.")
+
+    try:
+        lat, lng = float(payload['lat']), float(payload['lng'])
+    except (TypeError, ValueError):
+        raise ValueError("Invalid position provided, expected numbers.")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Invalid position provided, out of bounds.")
+
+    shape_geojson = payload.get('shape_geojson', None)
+    if shape_geojson is not None:
+        # Validate the shape once, it is output verbatim afterwards
+        shape_geojson = geo.normalize_geojson_geometry(shape_geojson)
+
+    r = Report(
+        type=payload['type'],
+        lat=lat,
+        lng=lng,
+        source=payload.get('source', 'unknown'),
+        shape_geojson=shape_geojson
+    )
+    # Handle expiration
+    if r.type in ['accident', 'gcum']:
+        r.expiration_datetime = (
+            arrow.get(UTC_now()).shift(hours=+1).naive
+        )
+    return r
+
+
 @bottle.route('/api/v1/reports/:id/upvote', ["POST", "OPTIONS"])
 def upvote_report(id):
     """
@@ -238,25 +894,25 @@ def upvote_report(id):
     except AuthenticationError:
         return jsonapi.JsonApiError(403, "Invalid authentication.")
 
-    r = Report.get(Report.id == id)
+    r = _upvote(id)
     if not r:
         return jsonapi.JsonApiError(404, "Invalid report id.")
-    # Increase upvotes
-    r.upvotes += 1
-    # Update report datetime
-    r.datetime = UTC_now()
-    # Update expiration datetime
-    if r.type in ['accident', 'gcum']:
-        r.expiration_datetime = (
-            arrow.get(UTC_now()).shift(hours=+1).naive
-        )
-    r.save()
 
     return {
         "data": r.to_json()
     }
 
 
+def _upvote(id):
+    """
+    Upvote a report.
+
+    :param id: Id of the report to upvote.
+    :return: The updated report, or ``None`` if there is no such report.
+    """
+    return _vote(id, upvotes=1)
+
+
 @bottle.route('/api/v1/reports/:id/downvote', ["POST", "OPTIONS"])
 def downvote_report(id):
     """
@@ -296,17 +952,259 @@ def downvote_report(id):
     except AuthenticationError:
         return jsonapi.JsonApiError(403, "Invalid authentication.")
 
-    r = Report.get(Report.id == id)
+    r = _downvote(id)
     if not r:
         return jsonapi.JsonApiError(404, "Invalid report id.")
-    r.downvotes += 1
-    r.save()
 
     return {
         "data": r.to_json()
     }
 
 
+def _downvote(id):
+    """
+    Downvote a report.
+
+    :param id: Id of the report to downvote.
+    :return: The updated report, or ``None`` if there is no such report.
+    """
+    return _vote(id, downvotes=1)
+
+
+def _vote(id, upvotes=0, downvotes=0, buffered=True):
+    """
+    Vote for a report. If the votes buffer is enabled, the votes are only
+    written at the next flush of the buffer.
+
+    :param id: Id of the report.
+    :param upvotes: Number of upvotes.
+    :param downvotes: Number of downvotes.
+    :param buffered: Whether the votes can go through the votes buffer.
+        Votes in a transaction should be written right away.
+    :return: The updated report, including the pending votes, or ``None`` if
+        there is no such report.
+    """
+    now = UTC_now()
+    if not buffered or not votes_buffer.enabled:
+        r = _apply_votes(id, upvotes, downvotes, now if upvotes else None)
+        if r is not None and not db.in_transaction():
+            # Within a transaction, the caller notifies once committed
+            changes.notifier.notify()
+        return r
+
+    # The pending votes must not be flushed between the read of the report
+    # and the addition of the votes
+    with votes_buffer.paused_flushes():
+        r = Report.get_or_none(Report.id == id)
+        if r is None:
+            return None
+        upvotes, downvotes, last_upvote = votes_buffer.add(
+            r.id, upvotes, downvotes, now
+        )
+    # Reflect the pending votes as they will be applied
+    r.upvotes += upvotes
+    r.downvotes += downvotes
+    if last_upvote is not None:
+        r.datetime = last_upvote
+        if r.type in ['accident', 'gcum']:
+            r.expiration_datetime = (
+                arrow.get(last_upvote).shift(hours=+1).naive
+            )
+    return r
+
+
+def _apply_votes(id, upvotes, downvotes, last_upvote):
+    """
+    Write votes on a report to the database, in a single update.
+
+    :param id: Id of the report.
+    :param upvotes: Number of upvotes.
+    :param downvotes: Number of downvotes.
+    :param last_upvote: Datetime of the last upvote, if any.
+    :return: The updated report, or ``None`` if there is no such report.
+    """
+    updates = {}
+    if upvotes:
+        # Increase upvotes
+        updates['upvotes'] = Report.upvotes + upvotes
+        # Update report datetime
+        updates['datetime'] = last_upvote
+        # Update expiration datetime
+        updates['expiration_datetime'] = peewee.Case(None, [(
+            Report.type << ['accident', 'gcum'],
+            arrow.get(last_upvote).shift(hours=+1).naive
+        )], Report.expiration_datetime)
+    if downvotes:
+        updates['downvotes'] = Report.downvotes + downvotes
+    return update_report(id, **updates)
+
+
+# Buffer of the pending votes, see VOTES_FLUSH_INTERVAL
+votes_buffer = votes.VoteBuffer(_apply_votes)
+
+
+@bottle.route('/api/v1/batch', ["POST", "OPTIONS"])
+def post_batch():
+    """
+    API v1 POST batch route.
+
+    Apply several report creations and votes at once, in a single database
+    transaction. Each operation is validated and applied on its own, an
+    invalid operation does not prevent the other ones from being applied.
+
+    Example::
+
+        > POST /api/v1/batch
+        > {
+        >     "operations": [
+        >         {
+        >             "op": "create",
+        >             "data": {
+        >                 "type": "pothole",
+        >                 "lat": 48.84219652060494,
+        >                 "lng": 2.385234797066081
+        >             }
+        >         },
+        >         {"op": "upvote", "id": 1161},
+        >         {"op": "downvote", "id": 4242}
+        >     ]
+        > }
+
+        {
+            "results": [
+                {
+                    "status": 201,
+                    "data": {
+                        "attributes": {…},
+                        "type": "reports",
+                        "id": 1162
+                    }
+                },
+                {
+                    "status": 200,
+                    "data": {
+                        "attributes": {…},
+                        "type": "reports",
+                        "id": 1161
+                    }
+                },
+                {
+                    "status": 404,
+                    "detail": "Invalid report id."
+                }
+            ],
+            "meta": {
+                "count": 3,
+                "errors": 1
+            }
+        }
+
+    :return: The result of each operation, in the order of the operations, in
+        a JSON ``results`` list.
+    """
+    # Handle CORS
+    if bottle.request.method == 'OPTIONS':
+        return {}
+
+    # Check authentication
+    try:
+        check_auth()
+    except AuthenticationError:
+        return jsonapi.JsonApiError(403, "Invalid authentication.")
+
+    try:
+        payload = json.load(bottle.request.body)
+    except ValueError as exc:
+        return jsonapi.JsonApiError(400, "Invalid JSON payload: " + str(exc))
+
+    operations = (
+        payload.get('operations') if isinstance(payload, dict) else None
+    )
+    if not isinstance(operations, list):
+        return jsonapi.JsonApiError(
+            400, "Invalid batch payload: expected an operations list."
+        )
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonapi.JsonApiError(
+            413,
+            "Too many operations, at most %d are allowed." % (
+                BATCH_MAX_OPERATIONS
+            )
+        )
+
+    # Validate all the operations before opening the transaction
+    prepared = [_prepare_operation(operation) for operation in operations]
+
+    results = []
+    with db.atomic():
+        for operation in prepared:
+            if 'detail' in operation:
+                results.append(operation)
+            else:
+                results.append(_apply_operation(operation))
+    if any('data' in x for x in results):
+        # Once committed, so that streams see the changes
+        changes.notifier.notify()
+
+    return {
+        "results": results,
+        "meta": {
+            "count": len(results),
+            "errors": sum(1 for x in results if 'detail' in x),
+        }
+    }
+
+
+def _prepare_operation(operation):
+    """
+    Validate an operation of a batch.
+
+    :param operation: An item of the batch operations list.
+    :return: A dict with the operation name and its argument (``report`` for
+        creations, ``id`` for votes), or an error result.
+    """
+    if not isinstance(operation, dict):
+        return dict(status=400, detail="Invalid operation: expected an object.")
+
+    op = operation.get('op')
+    if op == 'create':
+        try:
+            return dict(op=op, report=_build_report(operation.get('data')))
+        except (KeyError, ValueError) as exc:
+            return dict(
+                status=400, detail="Invalid report payload: " + str(exc)
+            )
+    elif op in ('upvote', 'downvote'):
+        try:
+            return dict(op=op, id=int(operation['id']))
+        except (KeyError, TypeError, ValueError):
+            return dict(status=404, detail="Invalid report id.")
+    return dict(status=400, detail="Invalid operation: %r." % (op,))
+
+
+def _apply_operation(operation):
+    """
+    Apply a validated operation of a batch, see ``_prepare_operation``.
+
+    :param operation: The validated operation.
+    :return: The result of the operation, as a dict with a ``data`` item or
+        an error.
+    """
+    if operation['op'] == 'create':
+        r = operation['report']
+        r.save()
+        return dict(status=201, data=r.to_json())
+
+    # Votes are part of the batch transaction, bypassing the votes buffer
+    if operation['op'] == 'upvote':
+        r = _vote(operation['id'], upvotes=1, buffered=False)
+    else:
+        r = _vote(operation['id'], downvotes=1, buffered=False)
+    if not r:
+        return dict(status=404, detail="Invalid report id.")
+    return dict(status=200, data=r.to_json())
+
+
 @bottle.route('/api/v1/stats', ["GET", "OPTIONS"])
 def get_stats():
     """
@@ -321,29 +1219,185 @@ def get_stats():
                 "nb_active_reports": 606,
                 "nb_reports": 1162,
                 "last_added_report_datetime": "2018-10-17T13:44:16+00:00",
+                "nb_archived_reports": 412,
                 …
             }
         }
 
+    .. note::
+
+        Active reports are counted at the beginning of the current minute
+        (see ``CACHE_TIME_BUCKET``), so that the response can be validated
+        through its ``ETag`` and ``Last-Modified`` headers.
+
+    .. note::
+
+        Stats are read from counters maintained on each write to the reports,
+        so that they can be polled at constant cost.
+        ``last_added_report_datetime`` is ``null`` if there are no reports.
+        ``nb_reports`` includes the archived reports.
+
     :return: The available stats about the instance in a JSON ``data`` dict.
     """
     # Handle CORS
     if bottle.request.method == 'OPTIONS':
         return {}
 
-    nb_reports = Report.select().count()
-    nb_active_reports = Report.select().where(
-        (Report.expiration_datetime == None) |
-        (Report.expiration_datetime > UTC_now())
-    ).count()
-    last_added_report_datetime = Report.select().order_by(
-        Report.datetime.desc()
-    ).get().datetime
+    # Answer conditional requests if the data did not change
+    now = cache.bucket_timestamp(time.time())
+    data_version, last_modified = get_data_version()
+    if last_modified is not None:
+        last_modified = max(last_modified, arrow.get(now).naive)
+    etag = cache.make_etag((bottle.request.path, now), data_version)
+    if cache.is_not_modified(etag, last_modified):
+        return cache.not_modified(etag, last_modified)
 
+    (
+        nb_reports, nb_active_reports, last_added_report_datetime,
+        nb_archived_reports
+    ) = get_reports_stats(arrow.get(now).naive)
+
+    cache.set_validators(etag, last_modified)
     return {
         "data": {
             "nb_reports": nb_reports,
             "nb_active_reports": nb_active_reports,
-            "last_added_report_datetime": last_added_report_datetime
+            "last_added_report_datetime": last_added_report_datetime,
+            "nb_archived_reports": nb_archived_reports
         }
     }
+
+
+@bottle.route('/api/v1/tiles/:z/:x/:y', ["GET", "OPTIONS"])
+def get_tile(z, x, y):
+    """
+    API v1 GET map tile route. Get the active reports in a map tile, as a
+    GeoJSON ``FeatureCollection``.
+
+    Example::
+
+        > GET /api/v1/tiles/13/4150/2818
+
+        {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "properties": {
+                        "type": "reports",
+                        "id": 1,
+                        "type": "interrupt",
+                        …
+                    },
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [2.386278, 48.842005]
+                    }
+                },
+                …
+            ]
+        }
+
+    .. note::
+
+        Tiles follow the XYZ scheme used by Leaflet and OpenStreetMap. Shapes
+        are clipped to the tile. Tiles below ``TILES_MIN_ZOOM`` are not
+        served, use ``/api/v1/reports`` instead.
+
+    .. note::
+
+        Only some fields can be requested through the ``fields[reports]``
+        GET param, as for ``/api/v1/reports``. Other GET params are rejected
+        with a 400 error.
+
+    .. note::
+
+        Tiles are computed at the beginning of the current minute (see
+        ``CACHE_TIME_BUCKET``) and can be cached by clients and proxies for
+        this duration.
+
+    :return: The active reports in the tile, as GeoJSON.
+    """
+    # Handle CORS
+    if bottle.request.method == 'OPTIONS':
+        return {}
+
+    try:
+        z, x, y = int(z), int(x), int(y)
+    except ValueError:
+        return jsonapi.JsonApiError(404, "Invalid tile.")
+    if not (0 <= z <= geo.TILES_MAX_ZOOM and 0 <= x < 2 ** z and
+            0 <= y < 2 ** z):
+        return jsonapi.JsonApiError(404, "Invalid tile.")
+    if z < TILES_MIN_ZOOM:
+        return jsonapi.JsonApiError(
+            400,
+            "Invalid parameters: zoom level should be at least {}.".format(
+                TILES_MIN_ZOOM
+            )
+        )
+
+    # Only sparse fieldsets are supported, other parameters would be ignored
+    # while creating their own cache entries
+    try:
+        for param in bottle.request.query:
+            if param != 'fields[reports]':
+                raise ValueError(
+                    "Invalid parameter provided: {}.".format(param)
+                )
+        fields = jsonapi.JsonApiParseFields(
+            bottle.request.query, 'reports', serializers.REPORT_FIELDS
+        )
+    except ValueError as exc:
+        return jsonapi.JsonApiError(400, "Invalid parameters: " + str(exc))
+
+    now = arrow.get(cache.bucket_timestamp(time.time())).naive
+    fields_key = None
+    if fields is not None:
+        fields_key = tuple(field.name for field in fields)
+    return _cached_response(
+        (bottle.request.path, fields_key, now),
+        lambda: _get_tile(geo.tile_bbox(z, x, y), fields, now),
+        now=now,
+        cache_control='public, max-age={}'.format(cache.CACHE_TIME_BUCKET)
+    )
+
+
+def _get_tile(bbox, fields, now):
+    """
+    Query the reports and serialize the response of ``get_tile``.
+
+    :param bbox: Bounding box of the tile.
+    :param fields: List of fields to output, ``None`` for all.
+    :param now: Naive UTC datetime to check the expiration of the reports
+        against.
+    :return: A generator of the chunks of the JSON response.
+    """
+    query = Report.select().where(
+        geo.shapes_bbox_filter(Report, bbox),
+        (Report.expiration_datetime == None) |
+        (Report.expiration_datetime > now),
+        Report.downvotes < REPORT_DOWNVOTES_THRESHOLD
+    )
+    return _stream_tile(query, bbox, fields)
+
+
+def _stream_tile(query, bbox, fields=None):
+    """
+    Serialize the reports of a tile incrementally.
+
+    The query is only executed once the stream is consumed.
+
+    :param query: A query on reports.
+    :param bbox: Bounding box of the tile.
+    :param fields: Optional list of fields to output, defaults to all.
+    :return: A generator of the chunks of the JSON response.
+    """
+    chunks = jsonapi.JsonApiStreamList(
+        '{"type": "FeatureCollection", "features": [',
+        serializers.reports_to_tile_features(query, bbox, fields),
+        ']}',
+        encoded=True
+    )
+    for chunk in chunks:
+        yield chunk
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Fast serialization of reports listings.
+
+Rows are read as plain tuples from the database cursor, without building
+model instances, and produce the same output as ``Report.to_json`` and
+``Report.to_geojson_feature``.
+"""
+import calendar
+import datetime
+import json
+
+import arrow
+import peewee
+
+from server import geo
+from server.jsonapi import DateAwareJSONEncoder
+from server.models import Report, REPORT_INTERNAL_FIELDS
+
+# Fields of the reports exposed through the API, in the order of
+# model_to_dict
+REPORT_FIELDS = [
+    field for field in Report._meta.sorted_fields
+    if field.name not in [x.name for x in REPORT_INTERNAL_FIELDS]
+]
+
+# Coordinates are output as integers in the columnar format, in units of
+# 1/COLUMNAR_COORDINATES_SCALE degree (about 1m)
+COLUMNAR_COORDINATES_SCALE = 100000
+
+
+def format_datetime(value, field=Report.datetime):
+    """
+    Format a datetime as an ISO 8601 string, as ``DateAwareJSONEncoder``
+    does.
+
+    :param value: A datetime, usually naive and in UTC, or ``None``. Raw
+        values from the database cursor are accepted as well.
+    :param field: The datetime field the raw value comes from.
+    :return: The formatted datetime.
+    """
+    if value is None:
+        return None
+    if (
+        isinstance(value, str) and len(value) in (19, 26) and
+        value[10] == ' '
+    ):
+        # Fast path for datetimes stored as strings (SQLite), in the format
+        # written by peewee: YYYY-MM-DD HH:MM:SS[.ffffff]
+        return value[:10] + 'T' + value[11:] + '+00:00'
+    value = field.python_value(value)
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        # Fast path for naive datetimes, considered as UTC
+        return value.isoformat() + '+00:00'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return arrow.get(value).isoformat()
+    return value
+
+
+def datetime_to_timestamp(value, field=Report.datetime):
+    """
+    Convert a datetime to a UNIX timestamp, in seconds.
+
+    :param value: A naive UTC datetime or ``None``. Raw values from the
+        database cursor are accepted as well.
+    :param field: The datetime field the raw value comes from.
+    :return: The timestamp, as an integer.
+    """
+    if value is None:
+        return None
+    value = field.python_value(value)
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        value = arrow.get(value).to('UTC').naive
+    return calendar.timegm(value.utctimetuple())
+
+
+def _iterate_rows(query, fields, serialize_datetimes=True):
+    """
+    Iterate over the rows of a query on reports, with serialized datetimes.
+
+    :param query: A query on reports, or on archived reports.
+    :param fields: The fields to select, as fields of ``Report``.
+    :param serialize_datetimes: Whether to format datetimes as ISO 8601
+        strings. Otherwise, raw values from the database cursor are kept.
+    :return: A generator of iterables of ``(field name, value)`` pairs.
+    """
+    # Select the fields of the queried model
+    fields = [getattr(query.model, field.name) for field in fields]
+    names = [field.name for field in fields]
+    datetime_fields = [
+        (index, field) for index, field in enumerate(fields)
+        if isinstance(field, peewee.DateTimeField) and serialize_datetimes
+    ]
+    # Read raw values from the cursor, skipping peewee conversions, as the
+    # database driver already returns Python values for the other types.
+    cursor = query.model._meta.database.execute(query.select(*fields))
+    for row in cursor:
+        row = list(row)
+        for index, field in datetime_fields:
+            row[index] = format_datetime(row[index], field)
+        yield zip(names, row)
+
+
+def _merge_fields(*fields_lists):
+    """
+    Merge lists of fields, removing duplicates and keeping order.
+    """
+    merged, names = [], set()
+    for fields in fields_lists:
+        for field in fields:
+            if field.name not in names:
+                merged.append(field)
+                names.add(field.name)
+    return merged
+
+
+def reports_to_json(query, fields=None, keys=None):
+    """
+    Serialize the reports from a query, as ``Report.to_json`` does.
+
+    :param query: A query on reports.
+    :param fields: Optional list of fields to output, defaults to
+        ``REPORT_FIELDS``. Only these fields are read from the database.
+    :param keys: Optional list of fields whose values should be returned
+        along with each report, to build pagination cursors.
+    :return: A generator of JSON-serializable dicts, or of tuples of such a
+        dict and the list of values of ``keys`` if ``keys`` is provided.
+    """
+    if fields is None:
+        fields = REPORT_FIELDS
+    names = [field.name for field in fields if field.name != 'id']
+    key_names = [field.name for field in keys or []]
+    selected_fields = _merge_fields([Report.id], fields, keys or [])
+    for row in _iterate_rows(query, selected_fields):
+        values = dict(row)
+        item = {
+            "type": "reports",
+            "id": values["id"],
+            "attributes": {
+                name: values[name] for name in names
+            }
+        }
+        if keys:
+            yield item, [values[name] for name in key_names]
+        else:
+            yield item
+
+
+def reports_to_columns(query, fields=None, keys=None, reverse=False):
+    """
+    Serialize the reports from a query in a columnar format, that is as
+    parallel lists of the values of each field.
+
+    Coordinates are quantized to integers (see
+    ``COLUMNAR_COORDINATES_SCALE``) and datetimes are converted to UNIX
+    timestamps.
+
+    :param query: A query on reports.
+    :param fields: Optional list of fields to output, defaults to
+        ``REPORT_FIELDS``. Only these fields are read from the database.
+    :param keys: Optional list of fields whose values should be returned
+        for each report, to build pagination cursors.
+    :param reverse: Whether to output the reports in reverse order.
+    :return: A dict of the lists of values, by field name, or a tuple of
+        such a dict and of the lists of values of ``keys`` for each report
+        if ``keys`` is provided.
+    """
+    if fields is None:
+        fields = REPORT_FIELDS
+    selected_fields = _merge_fields([Report.id], fields, keys or [])
+    converters = {}
+    for field in selected_fields:
+        if isinstance(field, peewee.DateTimeField):
+            converters[field.name] = (
+                lambda value, field=field: datetime_to_timestamp(value, field)
+            )
+        elif field.name in ['lat', 'lng']:
+            converters[field.name] = (
+                lambda value: None if value is None else int(round(
+                    value * COLUMNAR_COORDINATES_SCALE
+                ))
+            )
+    key_converters = [
+        (
+            field.name,
+            (lambda value, field=field: format_datetime(value, field))
+            if isinstance(field, peewee.DateTimeField) else None
+        )
+        for field in keys or []
+    ]
+
+    rows = [
+        dict(row)
+        for row in _iterate_rows(
+            query, selected_fields, serialize_datetimes=False
+        )
+    ]
+    if reverse:
+        rows.reverse()
+
+    columns = {}
+    for field in _merge_fields([Report.id], fields):
+        converter = converters.get(field.name)
+        if converter is None:
+            columns[field.name] = [row[field.name] for row in rows]
+        else:
+            columns[field.name] = [
+                converter(row[field.name]) for row in rows
+            ]
+    if keys is None:
+        return columns
+    return columns, [
+        [
+            converter(row[name]) if converter else row[name]
+            for name, converter in key_converters
+        ]
+        for row in rows
+    ]
+
+
+def reports_to_geojson_features(query, fields=None):
+    """
+    Serialize the reports from a query, as ``Report.to_geojson_feature``
+    does.
+
+    Shapes are validated when written, so they are spliced verbatim in the
+    output instead of being decoded and encoded again.
+
+    :param query: A query on reports.
+    :param fields: Optional list of fields to output as properties, defaults
+        to ``REPORT_FIELDS``. The fields required to build the geometry are
+        always read from the database.
+    :return: A generator of GeoJSON features, as JSON strings.
+    """
+    if fields is None:
+        fields = REPORT_FIELDS
+    names = [field.name for field in fields]
+    selected_fields = _merge_fields(
+        fields, [Report.lat, Report.lng, Report.shape_geojson]
+    )
+    encoder = DateAwareJSONEncoder()
+    for row in _iterate_rows(query, selected_fields):
+        values = dict(row)
+        properties = {
+            "type": "reports",
+        }
+        for name in names:
+            properties[name] = values[name]
+
+        geometry = values["shape_geojson"]
+        if not geometry:
+            geometry = encoder.encode({
+                "type": "Point",
+                "coordinates": [values["lng"], values["lat"]]
+            })
+        yield (
+            '{"type": "Feature", "properties": ' +
+            encoder.encode(properties) +
+            ', "geometry": ' + geometry + '}'
+        )
+
+
+def reports_to_tile_features(query, bbox, fields=None):
+    """
+    Serialize the reports from a query as the GeoJSON features of a map
+    tile, with their shapes clipped to the tile.
+
+    :param query: A query on reports.
+    :param bbox: Bounding box of the tile, as a tuple ``(min_lng, min_lat,
+        max_lng, max_lat)``.
+    :param fields: Optional list of fields to output as properties, defaults
+        to ``REPORT_FIELDS``.
+    :return: A generator of GeoJSON features, as JSON strings. Reports
+        outside of the tile are skipped.
+    """
+    if fields is None:
+        fields = REPORT_FIELDS
+    names = [field.name for field in fields]
+    selected_fields = _merge_fields(
+        fields, [Report.lat, Report.lng, Report.shape_geojson]
+    )
+    encoder = DateAwareJSONEncoder()
+    for row in _iterate_rows(query, selected_fields):
+        values = dict(row)
+        has_shape = bool(values["shape_geojson"])
+        if has_shape:
+            try:
+                geometry = geo.clip_geometry(
+                    json.loads(values["shape_geojson"]), bbox
+                )
+            except (KeyError, TypeError, ValueError):
+                # Not a normalized shape, fall back to the position
+                has_shape = False
+        if not has_shape:
+            geometry = geo.clip_geometry({
+                "type": "Point",
+                "coordinates": [values["lng"], values["lat"]]
+            }, bbox)
+        if geometry is None:
+            continue
+
+        properties = {
+            "type": "reports",
+        }
+        for name in names:
+            properties[name] = values[name]
+        yield (
+            '{"type": "Feature", "properties": ' +
+            encoder.encode(properties) +
+            ', "geometry": ' + encoder.encode(geometry) + '}'
+        )
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Write-behind buffer of the votes on reports.
+
+When enabled, votes are accumulated in memory and periodically flushed to the
+database as a single aggregated update per report, so that a storm of votes
+on a popular report does not result in one transaction per vote. Buffers are
+per process, pending votes are lost if the process is killed.
+"""
+import atexit
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from server import changes
+from server.models import db
+
+# Interval between two flushes of the pending votes, in milliseconds. 0
+# disables the buffer, each vote being written immediately.
+VOTES_FLUSH_INTERVAL = int(os.environ.get('VOTES_FLUSH_INTERVAL', '0'))
+
+
+class VoteBuffer(object):
+    """
+    A thread-safe buffer of pending votes, by report id.
+
+    Each pending entry is a list of the number of upvotes, the number of
+    downvotes and the datetime of the last upvote (or ``None``).
+    """
+    def __init__(self, apply_votes, interval=VOTES_FLUSH_INTERVAL):
+        """
+        :param apply_votes: Function writing the votes on a report to the
+            database, called with the report id, the number of upvotes, the
+            number of downvotes and the datetime of the last upvote.
+        :param interval: Interval between two flushes, in milliseconds.
+        """
+        self.apply_votes = apply_votes
+        self.interval = interval
+        self._reset()
+        # Pending votes are flushed by the parent process, and threads do not
+        # survive a fork
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        # Flushes wait for the readers (see paused_flushes) and the other
+        # flushes, and new readers wait for the flush in progress
+        self._flush_condition = threading.Condition()
+        self._flushing = False
+        self._readers = 0
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def add(self, id, upvotes=0, downvotes=0, now=None):
+        """
+        Record votes on a report, to be written at the next flush.
+
+        :param id: Id of the voted report.
+        :param upvotes: Number of upvotes.
+        :param downvotes: Number of downvotes.
+        :param now: Datetime of the votes.
+        :return: The pending entry of the report, including these votes, see
+            ``pending``.
+        """
+        self._start()
+        with self._lock:
+            return self._merge(id, upvotes, downvotes, now if upvotes else None)
+
+    def _merge(self, id, upvotes, downvotes, last_upvote):
+        """
+        Add votes to the pending entry of a report. Must be called with the
+        lock held.
+        """
+        entry = self._pending.setdefault(id, [0, 0, None])
+        entry[0] += upvotes
+        entry[1] += downvotes
+        if last_upvote is not None and (
+            entry[2] is None or entry[2] < last_upvote
+        ):
+            entry[2] = last_upvote
+        return tuple(entry)
+
+    def pending(self, id):
+        """
+        Get the pending votes on a report.
+
+        :param id: Id of the report.
+        :return: A tuple of the number of upvotes, the number of downvotes and
+            the datetime of the last upvote, not yet written.
+        """
+        with self._lock:
+            return tuple(self._pending.get(id, (0, 0, None)))
+
+    @contextlib.contextmanager
+    def paused_flushes(self):
+        """
+        Context manager preventing flushes meanwhile, so that the reports read
+        from the database are consistent with the pending votes: votes are
+        either written to the database or pending, never in between.
+        """
+        with self._flush_condition:
+            self._flush_condition.wait_for(lambda: not self._flushing)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._flush_condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._flush_condition.notify_all()
+
+    def flush(self):
+        """
+        Write all the pending votes to the database, in a single transaction.
+
+        If the transaction fails, the votes are kept pending for the next
+        flush.
+
+        :return: The number of updated reports.
+        """
+        with self._flush_condition:
+            self._flush_condition.wait_for(lambda: not self._flushing)
+            self._flushing = True
+            self._flush_condition.wait_for(lambda: not self._readers)
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            try:
+                with db.atomic():
+                    for id, entry in pending.items():
+                        self.apply_votes(id, *entry)
+            except Exception:
+                with self._lock:
+                    for id, entry in pending.items():
+                        self._merge(id, *entry)
+                raise
+        finally:
+            with self._flush_condition:
+                self._flushing = False
+                self._flush_condition.notify_all()
+        changes.notifier.notify()
+        return len(pending)
+
+    def _start(self):
+        """
+        Start the flushing thread, if not already running in this process.
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._flush_periodically, name='votes', daemon=True
+            )
+            self._thread.start()
+        atexit.register(self._flush_with_db)
+
+    def _flush_with_db(self):
+        db.connect(reuse_if_open=True)
+        try:
+            self.flush()
+        except Exception:
+            logging.exception('Unable to flush the pending votes.')
+        finally:
+            if not db.is_closed():
+                db.close()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval / 1000.0)
+            self._flush_with_db()